@@ -1,26 +1,358 @@
+import math
 import os
-from flask import Flask, request, abort, jsonify
+import operator
+from datetime import datetime
+from flask import Flask, Response, current_app, g, request, abort, jsonify, stream_with_context
 from flask_cors import CORS
-from models import setup_db, Actor, Movie
-from auth import requires_auth
+from werkzeug.exceptions import ServiceUnavailable
+from models import setup_db, pool_stats, db, validate, bulk_insert, bulk_update, bulk_delete, Actor, Movie, Cast, TableStats
+from auth import requires_auth, check_permissions, init_auth, token_cache
+from idempotency import idempotent, init_idempotency
+from data_transfer import data_cli
+from etags import conditional
+from cache import read_cache
+from search import SEARCH_TYPES, search_text
+from json_provider import FastJSONProvider
+from compression import compress_response
+from instrumentation import init_instrumentation, timed
+from replicas import init_replicas
+from changes import CHANGES_MAX_WAIT, CHANGES_POLL_INTERVAL, change_events, init_audit, wait_for_changes, waiters
 
 """
 https://yozdmr.us.auth0.com/authorize?audience=final&response_type=token&client_id=7Ejk1ltE8jklzHIGBDAjMfUJWBoRNOuW&redirect_uri=http://127.0.0.1:5000/login-results
 """
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+MAX_BATCH_SIZE = 50000
+
+DEFAULT_SEARCH_SIZE = 20
+MAX_SEARCH_SIZE = 100
+
+# Permission needed to search each type
+SEARCH_PERMISSIONS = {
+    'actors': 'get:actor',
+    'movies': 'get:movie'
+}
+
+# Permission needed to follow the changes of each table
+CHANGE_PERMISSIONS = {
+    'actors': 'get:actor',
+    'movies': 'get:movie',
+    'cast': 'get:movie'
+}
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+EVENT_STREAM_MIMETYPE = 'text/event-stream'
+STREAM_BATCH_SIZE = 1000
+
+# Filters accepted by the list endpoints: arg -> (column, comparison, parser)
+ACTOR_FILTERS = {
+    'age_min': (Actor.age, operator.ge, int),
+    'age_max': (Actor.age, operator.le, int),
+    'gender': (Actor.gender, operator.eq, str)
+}
+MOVIE_FILTERS = {
+    'released_after': (Movie.release_date, operator.gt, datetime.fromisoformat),
+    'released_before': (Movie.release_date, operator.lt, datetime.fromisoformat)
+}
+
+
+# ------------------------------
+# Casts
+# ------------------------------
+# The related rows of a page are read with one IN query on the ids of the
+# page, so including them costs one more query however long the page is.
+
+# Gets the actors of each of the movies, as {movie_id: [actor, ...]} in the
+# order of the credits. Each actor also has the role and billing of the cast.
+def get_movie_actors(movie_ids):
+    query = (
+        db.select(Cast.movie_id, Cast.role, Cast.billing, *Actor.__table__.columns)
+        .join(Cast.actor)
+        .where(Cast.movie_id.in_(movie_ids))
+        .order_by(Cast.movie_id, Cast.billing.asc().nulls_last(), Cast.actor_id)
+    )
+    actors = {id: [] for id in movie_ids}
+    for row in db.session.execute(query):
+        actor = dict(row._mapping)
+        actors[actor.pop('movie_id')].append(actor)
+    return actors
+
+# Gets the movies of each of the actors, as {actor_id: [movie, ...]} by
+# release date
+def get_actor_movies(actor_ids):
+    query = (
+        db.select(Cast.actor_id, Cast.role, Cast.billing, *Movie.__table__.columns)
+        .join(Cast.movie)
+        .where(Cast.actor_id.in_(actor_ids))
+        .order_by(Cast.actor_id, Movie.release_date.asc().nulls_last(), Movie.id)
+    )
+    movies = {id: [] for id in actor_ids}
+    for row in db.session.execute(query):
+        movie = dict(row._mapping)
+        movies[movie.pop('actor_id')].append(movie)
+    return movies
+
+# Related rows the list endpoints can include: include arg -> (model, loader)
+INCLUDES = {
+    Movie: {'actors': (Actor, get_movie_actors)},
+    Actor: {'movies': (Movie, get_actor_movies)}
+}
+
+# Gets the names in the request's include arg
+def get_includes(model):
+    names = [name.strip() for name in request.args.get('include', '').split(',') if name.strip()]
+    if any(name not in INCLUDES[model] for name in names):
+        abort(400)
+    return names
+
+# Gets the other tables read by a list request, for its ETag and cache key
+def included_models(model):
+    includes = get_includes(model)
+    if not includes:
+        return []
+    return [Cast] + [INCLUDES[model][name][0] for name in includes]
+
+# Adds the included related rows to each of the rows of a page
+def add_includes(model, rows, includes):
+    if not rows:
+        return rows
+    ids = [row['id'] for row in rows]
+    for name in includes:
+        related = INCLUDES[model][name][1](ids)
+        for row in rows:
+            row[name] = related[row['id']]
+    return rows
+
+
+# Builds the query of a list endpoint from the request's after, fields and
+# filter args, ordered by id.
+def get_list_query(model, filters):
+    args = request.args
+    try:
+        after = int(args['after']) if 'after' in args else None
+    except ValueError:
+        abort(400)
+
+    # Only select the requested columns, the id is always needed for the cursor
+    columns = model.__table__.columns
+    selected = list(columns)
+    if 'fields' in args:
+        names = [name.strip() for name in args['fields'].split(',') if name.strip()]
+        if any(name not in columns for name in names):
+            abort(400)
+        selected = [columns['id']] + [columns[name] for name in names if name != 'id']
+
+    query = db.select(*selected).order_by(model.id)
+    if after is not None:
+        query = query.where(model.id > after)
+    for name, (column, compare, parse) in filters.items():
+        if name in args:
+            try:
+                value = parse(args[name])
+            except ValueError:
+                abort(400)
+            query = query.where(compare(column, value))
+
+    return query
+
+
+# Whether the client asked for format=rows: each row as an array, with the
+# names of the columns sent once, instead of as an object. This skips
+# building a dict per row and is about a third smaller on the wire.
+def wants_rows(model):
+    format = request.args.get('format', 'objects')
+    if format not in ('objects', 'rows'):
+        abort(400)
+    # Included rows are nested objects, which don't fit in the arrays
+    if format == 'rows' and get_includes(model):
+        abort(400)
+    return format == 'rows'
+
+
+# Gets one page of rows for a list endpoint, using keyset pagination on id.
+# Returns the names of the columns, the rows as tuples and the cursor of the
+# next page (None on the last page).
+def get_page(model, filters):
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        abort(400)
+
+    query = get_list_query(model, filters).limit(limit + 1)
+    result = db.session.execute(query)
+    columns = list(result.keys())
+    rows = [tuple(row) for row in result]
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][0]
+
+    return columns, rows, next_cursor
+
+
+# Builds a read cache key from the current version of model's table, so the
+# entries of a table stop being used as soon as it is written to
+def cache_key(model, *parts):
+    version = TableStats.get(model).version
+    return ':'.join([model.__tablename__, str(version)] + [str(part) for part in parts])
+
+# Gets a page of a list endpoint through the read cache. Returns the names of
+# the columns, the rows (as dicts with their includes, or as tuples for
+# format=rows) and the cursor of the next page.
+def get_cached_page(model, filters):
+    includes = get_includes(model)
+    compact = wants_rows(model)
+    versions = [TableStats.get(related).version for related in included_models(model)]
+    key = cache_key(model, 'page', *versions, request.full_path)
+
+    def load():
+        columns, rows, next_cursor = get_page(model, filters)
+        if not compact:
+            rows = add_includes(model, [dict(zip(columns, row)) for row in rows], includes)
+        return columns, rows, next_cursor
+
+    return read_cache.get(key, load)
+
+# Gets the formatted row with the given id through the read cache, or None
+def get_cached_row(model, id):
+    def load():
+        row = model.query.filter_by(id=id).one_or_none()
+        return None if row is None else row.format()
+
+    return read_cache.get(cache_key(model, 'id', id), load)
+
+
+# Whether the client asked for the rows as newline delimited JSON
+def wants_ndjson():
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+# Streams every row matching a list request as one JSON object per line, or
+# for format=rows the names of the columns and then one array per line. The
+# rows are read through a server side cursor in batches, so memory use doesn't
+# grow with the size of the table.
+def stream_rows(model, filters):
+    query = get_list_query(model, filters).execution_options(yield_per=STREAM_BATCH_SIZE)
+    includes = get_includes(model)
+    compact = wants_rows(model)
+
+    def generate():
+        result = db.session.execute(query)
+        columns = list(result.keys())
+        if compact:
+            yield current_app.json.dumps_lines([columns])
+        for rows in result.partitions():
+            if compact:
+                items = [tuple(row) for row in rows]
+            else:
+                items = add_includes(model, [dict(zip(columns, row)) for row in rows], includes)
+            with timed('serialize'):
+                lines = current_app.json.dumps_lines(items)
+            yield lines
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+# ------------------------------
+# Batches
+# ------------------------------
+
+BATCH_ERROR_MESSAGES = {
+    400: "bad request",
+    404: "page not found",
+    422: "unprocessable entity"
+}
+
+# Gets the id of a batch item, which must be an integer
+def get_item_id(item):
+    if isinstance(item, bool) or not isinstance(item, int):
+        raise ValueError('Expected an integer id.')
+    return item
+
+# Runs a batch request. Every item of the JSON array body is checked with
+# parse, then the valid ones are written together with write. The response
+# has one result per item, in the same order as the request.
+def run_batch(parse, write):
+    items = request.get_json()
+    if not isinstance(items, list) or len(items) == 0 or len(items) > MAX_BATCH_SIZE:
+        abort(400)
+
+    results = [None] * len(items)
+    values = []
+    indexes = []
+    for index, item in enumerate(items):
+        try:
+            values.append(parse(item))
+            indexes.append(index)
+        except ValueError:
+            results[index] = (None, 400)
+
+    for index, result in zip(indexes, write(values)):
+        results[index] = result
+
+    formatted_results = []
+    for index, (id, error) in enumerate(results):
+        result = {"index": index, "id": id, "success": error is None}
+        if error is not None:
+            result["error"] = error
+            result["message"] = BATCH_ERROR_MESSAGES[error]
+        formatted_results.append(result)
+
+    return {
+        "number_succeeded": sum(1 for _, error in results if error is None),
+        "results": formatted_results,
+        "success": True
+    }
+
+def insert_batch(model):
+    return run_batch(
+        lambda item: validate(model, item),
+        lambda rows: bulk_insert(model, rows)
+    )
+
+def update_batch(model):
+    def parse(item):
+        values = validate(model, item, partial=True)
+        if not values:
+            raise ValueError('Nothing to update.')
+        values['id'] = get_item_id(item.get('id'))
+        return values
+
+    return run_batch(parse, lambda rows: bulk_update(model, rows))
+
+def delete_batch(model):
+    return run_batch(get_item_id, lambda ids: bulk_delete(model, ids))
+
 # create and configure the app
 def create_app(test_config=None):
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    app.json = FastJSONProvider(app)
     setup_db(app)
+    replicas = init_replicas(app)
+    audit = init_audit(app)
+    idempotency = init_idempotency(app)
+    init_instrumentation(app)
+    app.cli.add_command(data_cli)
 
     # CORS stuff below
     CORS(app, resources={r"/api/*": {"origins": "*"}})
     @app.after_request
     def after_request(response):
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization')
-        response.headers.add('Access-Control-Allow-Headers', 'GET, POST, PATCH, DELETE, OPTIONS')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, Idempotency-Key')
+        response.headers.add('Access-Control-Allow-Headers', 'GET, POST, PUT, PATCH, DELETE, OPTIONS')
         return response
 
+    # Runs after the hook above (they run in reverse order), on the final body
+    app.after_request(compress_response)
+
     # NOTE: Auth permissions below
     # get/post/patch/delete  :  actor/movie
 
@@ -35,52 +367,77 @@ def create_app(test_config=None):
             "success": True
         })
 
+    # Gets the internal cache counters and the state of the replicas. Only
+    # for the operators, whose tokens have the get:stats permission.
+    @app.route('/stats')
+    @requires_auth('get:stats')
+    def stats(payload):
+        return jsonify({
+            "db_pool": pool_stats(),
+            "replicas": replicas.stats() if replicas is not None else {},
+            "audit_queue": audit.stats(),
+            "change_waiters": waiters.stats(),
+            "idempotency": idempotency.stats(),
+            "read_cache": read_cache.stats(),
+            "token_cache": token_cache.stats(),
+            "success": True
+        })
+
 
 
     # GET Routes ------------------------------
 
-    # Gets all of the actors
+    # Gets a page of the actors
     @app.route('/actors')
     @requires_auth('get:actor')
+    @conditional(Actor, depends=lambda: included_models(Actor))
     def get_actors(payload):
-        actors = Actor.query.all()
-        if actors != None:
-            formatted_actors = [actor.format() for actor in actors]
-            
-            return {
-                "number_actors": len(formatted_actors),
-                "actors": formatted_actors,
-                "success": True
-            }
-        else:
-            abort(400)
+        if wants_ndjson():
+            return stream_rows(Actor, ACTOR_FILTERS)
+
+        columns, actors, next_cursor = get_cached_page(Actor, ACTOR_FILTERS)
+
+        body = {
+            "number_actors": TableStats.count(Actor),
+            "actors": actors,
+            "next_cursor": next_cursor,
+            "success": True
+        }
+        if wants_rows(Actor):
+            body["columns"] = columns
+        return body
 
 
-    # Gets all of the movies
+    # Gets a page of the movies
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movie')
+    @conditional(Movie, depends=lambda: included_models(Movie))
     def get_movies(payload):
-        movies = Movie.query.all()
-        if movies != None:
-            formatted_movies = [movie.format() for movie in movies]
-            
-            return {
-                "number_movies": len(formatted_movies),
-                "movies": formatted_movies,
-                "success": True
-            }
-        else:
-            abort(400)
+        if wants_ndjson():
+            return stream_rows(Movie, MOVIE_FILTERS)
+
+        columns, movies, next_cursor = get_cached_page(Movie, MOVIE_FILTERS)
+
+        body = {
+            "number_movies": TableStats.count(Movie),
+            "movies": movies,
+            "next_cursor": next_cursor,
+            "success": True
+        }
+        if wants_rows(Movie):
+            body["columns"] = columns
+        return body
 
     # Gets actor by provided ID
     @app.route('/actors/<int:id>', methods=['GET'])
     @requires_auth('get:actor')
+    @conditional(Actor)
     def get_actor(payload, id):
-        actor = Actor.query.filter_by(id=id).one_or_none()
-        if actor != None and Actor.query.all() != None:
+        actor = get_cached_row(Actor, id)
+        if actor != None:
             return {
-                "number_actors": len(Actor.query.all()),
-                "actor": actor.format(),
+                "number_actors": TableStats.count(Actor),
+                "actor": actor,
                 "success": True
             }
         else:
@@ -89,17 +446,134 @@ def create_app(test_config=None):
     # Gets movie by provided ID
     @app.route('/movies/<int:id>', methods=['GET'])
     @requires_auth('get:movie')
+    @conditional(Movie)
     def get_movie(payload, id):
-        movie = Movie.query.filter_by(id=id).one_or_none()
-        if movie != None and Movie.query.all() != None:
+        movie = get_cached_row(Movie, id)
+        if movie != None:
             return {
-                "number_movies": len(Movie.query.all()),
-                "movie": movie.format(),
+                "number_movies": TableStats.count(Movie),
+                "movie": movie,
                 "success": True
             }
         else:
             abort(404)
 
+    # Gets the cast of a movie
+    @app.route('/movies/<int:id>/actors', methods=['GET'])
+    @requires_auth('get:actor')
+    @conditional(Movie, Actor, Cast)
+    def get_movie_cast(payload, id):
+        if db.session.get(Movie, id) is None:
+            abort(404)
+
+        return {
+            "movie_id": id,
+            "actors": get_movie_actors([id])[id],
+            "success": True
+        }
+
+    # Gets the movies an actor plays in
+    @app.route('/actors/<int:id>/movies', methods=['GET'])
+    @requires_auth('get:movie')
+    @conditional(Movie, Actor, Cast)
+    def get_actor_filmography(payload, id):
+        if db.session.get(Actor, id) is None:
+            abort(404)
+
+        return {
+            "actor_id": id,
+            "movies": get_actor_movies([id])[id],
+            "success": True
+        }
+
+
+
+    # Searches actor names and movie titles
+    @app.route('/search', methods=['GET'])
+    @requires_auth(any_of=set(SEARCH_PERMISSIONS.values()))
+    def search(payload):
+        q = request.args.get('q', '')
+        try:
+            limit = int(request.args.get('limit', DEFAULT_SEARCH_SIZE))
+        except ValueError:
+            abort(400)
+        if limit < 1 or limit > MAX_SEARCH_SIZE:
+            abort(400)
+
+        # Without a type, search everything the token is allowed to read
+        if 'type' in request.args:
+            types = request.args['type'].split(',')
+            if any(type not in SEARCH_TYPES for type in types):
+                abort(400)
+            for type in types:
+                check_permissions(SEARCH_PERMISSIONS[type], payload)
+        else:
+            types = [type for type in SEARCH_TYPES if SEARCH_PERMISSIONS[type] in g.grants.permissions]
+
+        try:
+            results, next_cursor = search_text(q, sorted(set(types)), limit, request.args.get('after'))
+        except ValueError:
+            abort(400)
+
+        return {
+            "results": [
+                {"type": type, "id": id, "text": text, "rank": rank}
+                for rank, type, id, text in results
+            ],
+            "next_cursor": next_cursor,
+            "success": True
+        }
+
+
+    # Gets the changes to the tables after the change with id since, waiting
+    # for one if there are none yet, or streams them as server-sent events
+    @app.route('/changes', methods=['GET'])
+    @requires_auth(any_of=set(CHANGE_PERMISSIONS.values()))
+    def get_changes(payload):
+        try:
+            since = int(request.headers.get('Last-Event-ID', request.args.get('since', 0)))
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+            wait = float(request.args.get('wait', 0))
+        except ValueError:
+            abort(400)
+        if limit < 1 or limit > MAX_PAGE_SIZE or wait < 0 or wait > CHANGES_MAX_WAIT:
+            abort(400)
+
+        # Without tables, follow every table the token is allowed to read
+        if 'tables' in request.args:
+            tables = request.args['tables'].split(',')
+            if any(table not in CHANGE_PERMISSIONS for table in tables):
+                abort(400)
+            for table in tables:
+                check_permissions(CHANGE_PERMISSIONS[table], payload)
+        else:
+            tables = [table for table in CHANGE_PERMISSIONS if CHANGE_PERMISSIONS[table] in g.grants.permissions]
+
+        # Streams and long polls hold a thread while they wait, so only
+        # CHANGES_MAX_WAITERS of them can run at once in each worker
+        streamed = request.accept_mimetypes.best_match(['application/json', EVENT_STREAM_MIMETYPE]) == EVENT_STREAM_MIMETYPE
+        if (streamed or wait > 0) and not waiters.acquire():
+            raise ServiceUnavailable("Too many requests are waiting for changes.", retry_after=math.ceil(CHANGES_POLL_INTERVAL))
+
+        if streamed:
+            response = Response(
+                stream_with_context(change_events(since, tables, limit)),
+                mimetype=EVENT_STREAM_MIMETYPE,
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+            response.call_on_close(waiters.release)
+            return response
+
+        try:
+            changes = wait_for_changes(since, tables, limit, wait)
+        finally:
+            if wait > 0:
+                waiters.release()
+        return {
+            "changes": changes,
+            "last_id": changes[-1]['id'] if changes else since,
+            "success": True
+        }
 
 
     # POST Routes ------------------------------
@@ -107,10 +581,11 @@ def create_app(test_config=None):
     # Posts actor
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actor')
+    @idempotent
     def post_actor(payload):
-        data = request.get_json()
-
-        if 'name' not in data or 'age' not in data or 'gender' not in data:
+        try:
+            data = validate(Actor, request.get_json())
+        except ValueError:
             abort(400)
         
         new_actor = Actor(
@@ -128,10 +603,11 @@ def create_app(test_config=None):
     # Posts movie
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movie')
+    @idempotent
     def post_movie(payload):
-        data = request.get_json()
-
-        if 'title' not in data or 'release_date' not in data:
+        try:
+            data = validate(Movie, request.get_json())
+        except ValueError:
             abort(400)
         
         new_movie = Movie(
@@ -151,13 +627,17 @@ def create_app(test_config=None):
     # Patches actor
     @app.route('/actors/<int:id>', methods=['PATCH'])
     @requires_auth('patch:actor')
+    @idempotent
     def patch_actor(payload, id: int):
-        data = request.get_json()
-        
         actor = Actor.query.filter_by(id=id).one_or_none()
 
         if actor == None:
             abort(404)
+
+        try:
+            data = validate(Actor, request.get_json(), partial=True)
+        except ValueError:
+            abort(400)
         
         # Updating values
         if 'name' in data:
@@ -177,14 +657,18 @@ def create_app(test_config=None):
     # Patches movie
     @app.route('/movies/<int:id>', methods=['PATCH'])
     @requires_auth('patch:movie')
+    @idempotent
     def patch_movie(payload, id: int):
-        data = request.get_json()
-        
         movie = Movie.query.filter_by(id=id).one_or_none()
 
         if movie == None:
             abort(404)
 
+        try:
+            data = validate(Movie, request.get_json(), partial=True)
+        except ValueError:
+            abort(400)
+
         # Updating values
         if 'title' in data:
             movie.title = data['title']
@@ -200,11 +684,34 @@ def create_app(test_config=None):
 
 
 
+    # Casts an actor in a movie, or changes their role
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['PUT'])
+    @requires_auth('patch:movie')
+    @idempotent
+    def put_cast(payload, movie_id: int, actor_id: int):
+        if db.session.get(Movie, movie_id) is None or db.session.get(Actor, actor_id) is None:
+            abort(404)
+
+        try:
+            data = validate(Cast, request.get_json(silent=True) or {}, partial=True)
+        except ValueError:
+            abort(400)
+
+        cast = Cast.put(movie_id, actor_id, data)
+
+        return {
+            "cast": cast.format(),
+            "success": True
+        }
+
+
+
     # DELETE Routes ------------------------------
 
     # Deletes actor based on given ID
     @app.route('/actors/<int:id>', methods=['DELETE'])
     @requires_auth('delete:actor')
+    @idempotent
     def delete_actor(payload, id: int):
         actor = Actor.query.filter_by(id=id).one_or_none()
         if actor == None:
@@ -221,6 +728,7 @@ def create_app(test_config=None):
     # Deletes movie based on given ID
     @app.route('/movies/<int:id>', methods=['DELETE'])
     @requires_auth('delete:movie')
+    @idempotent
     def delete_movie(payload, id: int):
         movie = Movie.query.filter_by(id=id).one_or_none()
         if movie == None:
@@ -233,6 +741,70 @@ def create_app(test_config=None):
             "success": True
         }
 
+    # Removes an actor from the cast of a movie
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>', methods=['DELETE'])
+    @requires_auth('patch:movie')
+    @idempotent
+    def delete_cast(payload, movie_id: int, actor_id: int):
+        cast = Cast.query.filter_by(movie_id=movie_id, actor_id=actor_id).one_or_none()
+        if cast == None:
+            abort(404)
+
+        formatted_cast = cast.format()
+        cast.delete()
+
+        return {
+            "deleted_cast": formatted_cast,
+            "success": True
+        }
+
+    # Batch Routes ------------------------------
+    # One JWT check and a few transactions for a whole array of writes
+
+    # Posts a batch of actors
+    @app.route('/actors/batch', methods=['POST'])
+    @requires_auth('post:actor')
+    @idempotent
+    def post_actors_batch(payload):
+        return insert_batch(Actor)
+
+    # Posts a batch of movies
+    @app.route('/movies/batch', methods=['POST'])
+    @requires_auth('post:movie')
+    @idempotent
+    def post_movies_batch(payload):
+        return insert_batch(Movie)
+
+    # Patches a batch of actors
+    @app.route('/actors/batch', methods=['PATCH'])
+    @requires_auth('patch:actor')
+    @idempotent
+    def patch_actors_batch(payload):
+        return update_batch(Actor)
+
+    # Patches a batch of movies
+    @app.route('/movies/batch', methods=['PATCH'])
+    @requires_auth('patch:movie')
+    @idempotent
+    def patch_movies_batch(payload):
+        return update_batch(Movie)
+
+    # Deletes a batch of actors
+    @app.route('/actors/batch', methods=['DELETE'])
+    @requires_auth('delete:actor')
+    @idempotent
+    def delete_actors_batch(payload):
+        return delete_batch(Actor)
+
+    # Deletes a batch of movies
+    @app.route('/movies/batch', methods=['DELETE'])
+    @requires_auth('delete:movie')
+    @idempotent
+    def delete_movies_batch(payload):
+        return delete_batch(Movie)
+
+
+
     # ------------------------------
     # Error handlers
     # ------------------------------
@@ -244,6 +816,23 @@ def create_app(test_config=None):
             "message": "bad request"
         }), 400
 
+    # The auth errors say what is wrong with the token
+    @app.errorhandler(401)
+    def unauthorized(error):
+        return jsonify({
+            "success": False,
+            'error': 401,
+            "message": error.description
+        }), 401
+
+    @app.errorhandler(403)
+    def forbidden(error):
+        return jsonify({
+            "success": False,
+            'error': 403,
+            "message": error.description
+        }), 403
+
     @app.errorhandler(404)
     def page_not_found(error):
         return jsonify({
@@ -260,6 +849,15 @@ def create_app(test_config=None):
             "message": "method not allowed"
         }), 405
 
+    # A request with the same Idempotency-Key is still running
+    @app.errorhandler(409)
+    def conflict(error):
+        return jsonify({
+            "success": False,
+            'error': 409,
+            "message": error.description
+        }), 409
+
     @app.errorhandler(422)
     def unprocessable_entity(error):
         return jsonify({
@@ -268,6 +866,16 @@ def create_app(test_config=None):
             "message": "unprocessable entity"
         }), 422
 
+    # Retry-After says when the client can send the request again
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        headers = {'Retry-After': str(error.retry_after)} if getattr(error, 'retry_after', None) else {}
+        return jsonify({
+            "success": False,
+            'error': 429,
+            "message": error.description
+        }), 429, headers
+
     @app.errorhandler(500)
     def internal_server_error(error):
         return jsonify({
@@ -276,11 +884,31 @@ def create_app(test_config=None):
             "message": "internal server error"
         }), 500
 
+    # Too many requests are waiting for changes in this worker
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        headers = {'Retry-After': str(error.retry_after)} if getattr(error, 'retry_after', None) else {}
+        return jsonify({
+            "success": False,
+            'error': 503,
+            "message": error.description
+        }), 503, headers
+
+    # Once every route is registered
+    init_auth(app)
+
     return app
 
 
-app = create_app()
+# The app is only created when app.app is first used (by gunicorn or the
+# flask command), so importing this module doesn't need a database
+def __getattr__(name):
+    global app
+    if name == 'app':
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=6969, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=6969, debug=True)
\ No newline at end of file
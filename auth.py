@@ -1,19 +1,40 @@
-from flask import Flask, request, abort, jsonify
+from flask import g, has_request_context, request, abort
+import hashlib
 import json
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
-from jose import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt, jwk
 from urllib.request import urlopen
+from werkzeug.exceptions import TooManyRequests
 
 import os
 from dotenv import load_dotenv
 
-app = Flask(__name__)
+from instrumentation import timed
+from ratelimit import rate_limiter
 
 load_dotenv(dotenv_path='authinfo.env')
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')  # EX: example.us.auth0.com
 ALGORITHMS = ['RS256']
 API_AUDIENCE = os.getenv('API_AUDIENCE')
 
+# JWKS caching (seconds). The TTL is used when Auth0 sends no Cache-Control
+# max-age, stale keys are served for up to JWKS_STALE_TTL past expiry while a
+# background refresh runs, and an unknown kid can force at most one refetch
+# per JWKS_MIN_REFRESH_INTERVAL.
+JWKS_CACHE_TTL = int(os.getenv('JWKS_CACHE_TTL', 600))
+JWKS_STALE_TTL = int(os.getenv('JWKS_STALE_TTL', 3600))
+JWKS_MIN_REFRESH_INTERVAL = int(os.getenv('JWKS_MIN_REFRESH_INTERVAL', 30))
+
+# Maximum number of verified tokens kept in memory
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+
 
 class AuthError(Exception):
     def __init__(self, error, status_code):
@@ -40,43 +61,462 @@ def get_token_auth_header():
     token = parts[1]
     return token
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        abort(400, "Authorization header is missing permission information.")
+# ------------------------------
+# Permissions
+# ------------------------------
+
+# The roles, each with the roles it includes and the permissions it adds
+ROLE_DEFINITIONS = {
+    'Casting Assistant': ((), ('get:actor', 'get:movie')),
+    'Casting Director': (('Casting Assistant',), ('post:actor', 'delete:actor', 'patch:actor', 'patch:movie')),
+    'Executive Producer': (('Casting Director',), ('post:movie', 'delete:movie'))
+}
+
+# Claim of the tokens listing their roles, whose permissions are added to
+# the token's. Unset, only the permissions claim is used.
+ROLES_CLAIM = os.getenv('AUTH_ROLES_CLAIM')
+
+# Gets every permission of each role, including those of the roles it
+# includes, from the most to the least permissive
+def expand_roles(definitions):
+    def permissions_of(role, seen=()):
+        if role in seen:
+            raise ValueError(f'The role {role!r} includes itself.')
+        included, added = definitions[role]
+        permissions = set(added)
+        for other in included:
+            permissions |= permissions_of(other, seen + (role,))
+        return frozenset(permissions)
+
+    roles = {role: permissions_of(role) for role in definitions}
+    return dict(sorted(roles.items(), key=lambda item: -len(item[1])))
+
+ROLES = expand_roles(ROLE_DEFINITIONS)
+
+
+class Grants:
+    """What a verified token allows: its permissions as a frozenset, with
+    those of its roles, and the most permissive role they cover. Built once
+    per token and cached with it."""
+
+    __slots__ = ('payload', 'permissions', 'role', 'valid')
+
+    def __init__(self, payload):
+        self.payload = payload
+        permissions = payload.get('permissions')
+        roles = payload.get(ROLES_CLAIM) if ROLES_CLAIM else None
+        self.valid = isinstance(permissions, list) or isinstance(roles, list)
+
+        permissions = set(permissions) if isinstance(permissions, list) else set()
+        for role in roles if isinstance(roles, list) else ():
+            permissions |= ROLES.get(role, frozenset())
+        self.permissions = frozenset(permissions)
+        self.role = next((role for role, role_permissions in ROLES.items() if role_permissions <= self.permissions), None)
+
+
+class Requirement:
+    """Permissions a route needs: all of all_of, and at least one of any_of
+    unless it is empty. An empty requirement only needs a valid token."""
+
+    __slots__ = ('all_of', 'any_of', 'name')
+
+    def __init__(self, all_of=(), any_of=()):
+        if isinstance(all_of, str):
+            all_of = (all_of,) if all_of else ()
+        if isinstance(any_of, str):
+            any_of = (any_of,) if any_of else ()
+        self.all_of = frozenset(all_of)
+        self.any_of = frozenset(any_of)
+
+        # e.g. "patch:movie" or "post:actor+post:movie get:actor|get:movie",
+        # for the rate limits and the audit log
+        parts = []
+        if self.all_of:
+            parts.append('+'.join(sorted(self.all_of)))
+        if self.any_of:
+            parts.append('|'.join(sorted(self.any_of)))
+        self.name = ' '.join(parts)
+
+    def allows(self, permissions):
+        return self.all_of <= permissions and (not self.any_of or not self.any_of.isdisjoint(permissions))
+
+    def __repr__(self):
+        return f'Requirement({self.name!r})'
+
+
+_requirements = {}
+
+# Gets the compiled requirement of a single permission
+def requirement_of(permission):
+    requirement = _requirements.get(permission)
+    if requirement is None:
+        requirement = _requirements[permission] = Requirement(permission)
+    return requirement
 
-    if permission not in payload['permissions']:
+# Gets the grants of payload, compiled by requires_auth for the current
+# request when it is the same token
+def get_grants(payload):
+    grants = g.get('grants') if has_request_context() else None
+    if grants is None or grants.payload is not payload:
+        grants = Grants(payload)
+    return grants
+
+def check_grants(requirement, grants):
+    if not grants.valid:
+        abort(400, "Authorization header is missing permission information.")
+    if not requirement.allows(grants.permissions):
         abort(403, "Authorization header is missing a required permission.")
-    
+
+# An empty permission only requires a valid token
+def check_permissions(permission, payload):
+    check_grants(requirement_of(permission), get_grants(payload))
     return True
 
+# Gets the most permissive role whose permissions the token has, or None
+def get_role(payload):
+    return get_grants(payload).role
+
+# Who sent a token: its subject, or for a token without one a hash of the
+# token, so such tokens don't share their rate limits and idempotency keys
+def token_client(payload, token):
+    subject = payload.get('sub')
+    if subject is not None:
+        return subject
+    return 'token:' + hashlib.sha256(token.encode()).hexdigest()
+
+# Limits the requests of each client, see ratelimit.py
+def check_rate_limit(permission, grants, client):
+    if not rate_limiter.limits:
+        return
+    wait = rate_limiter.check(client, grants.role, permission)
+    if wait > 0:
+        raise TooManyRequests("Too many requests, please slow down.", retry_after=math.ceil(wait))
+
+# Gets the permissions each route of app needs, as {(rule, method):
+# Requirement}, with None for the routes that don't need a token
+def route_permissions(app):
+    table = {}
+    for rule in app.url_map.iter_rules():
+        requirement = getattr(app.view_functions[rule.endpoint], 'requirement', None)
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            table[(rule.rule, method)] = requirement
+    return table
+
+# Builds the permission table of app's routes, once they are all registered,
+# and adds the `flask permissions` command to print it
+def init_auth(app):
+    app.extensions['route_permissions'] = route_permissions(app)
+
+    @app.cli.command('permissions')
+    def print_permissions():
+        """Prints the permissions each route needs."""
+        for (rule, method), requirement in sorted(app.extensions['route_permissions'].items()):
+            needed = 'public' if requirement is None else requirement.name or 'any valid token'
+            print(f'{method:7} {rule:50} {needed}')
+
+# ------------------------------
+# JWKS key store
+# ------------------------------
+
+def parse_max_age(cache_control):
+    # Returns the max-age of a Cache-Control header, or None if it has none
+    if not cache_control:
+        return None
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+    match = re.search(r'max-age=(\d+)', cache_control)
+    if match:
+        return int(match.group(1))
+    return None
+
+# A JWKS source is a callable returning (jwks, max_age) where max_age is the
+# lifetime the source advertised for the document, or None.
+def url_jwks_source(url, timeout=5):
+    def fetch():
+        with urlopen(url, timeout=timeout) as response:
+            jwks = json.loads(response.read())
+            max_age = parse_max_age(response.headers.get('Cache-Control'))
+        return jwks, max_age
+    return fetch
+
+def file_jwks_source(path):
+    def fetch():
+        with open(path) as f:
+            return json.load(f), None
+    return fetch
+
+def default_jwks_source():
+    if os.getenv('JWKS_FILE'):
+        return file_jwks_source(os.getenv('JWKS_FILE'))
+    url = os.getenv('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+    return url_jwks_source(url)
+
+
+class JWKSKeyStore:
+    """Process-wide cache of the signing keys published in a JWKS document.
+
+    Keys are parsed once per fetch and indexed by kid. Refreshes are
+    single-flight: concurrent requests that need new keys wait on the one
+    fetch already running instead of each hitting the source.
+    """
+
+    def __init__(self, source, ttl=JWKS_CACHE_TTL, stale_ttl=JWKS_STALE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.source = source
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = {}
+        self.loaded = False
+        self.fetched_at = 0.0
+        self.expires_at = 0.0
+        self._attempts = 0
+        self._lock = threading.Lock()
+        self._background_refresh = None
+
+    def set_source(self, source):
+        with self._lock:
+            self.source = source
+            self.keys = {}
+            self.loaded = False
+            self.fetched_at = 0.0
+            self.expires_at = 0.0
+
+    def get_key(self, kid):
+        now = time.monotonic()
+
+        if not self.loaded or now >= self.expires_at + self.stale_ttl:
+            self.refresh()
+        elif kid not in self.keys:
+            # Keys may have been rotated, but don't let garbage kids hammer
+            # the source.
+            if now - self.fetched_at >= self.min_refresh_interval:
+                self._refresh_quietly()
+        elif now >= self.expires_at:
+            # Serve the stale key and revalidate off the request path
+            self.refresh_in_background()
+
+        return self.keys.get(kid)
+
+    def refresh(self):
+        seen = self._attempts
+        with self._lock:
+            # Another thread fetched while we were waiting on the lock
+            if self._attempts != seen:
+                return
+            try:
+                self._fetch()
+            finally:
+                self._attempts += 1
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._background_refresh is not None and self._background_refresh.is_alive():
+                return
+            self._background_refresh = threading.Thread(target=self._refresh_quietly, daemon=True)
+            self._background_refresh.start()
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception:
+            # Keep serving the stale keys, the next request will try again
+            pass
+
+    def _fetch(self):
+        jwks, max_age = self.source()
+        keys = {}
+        for key in jwks.get('keys', []):
+            if key.get('kty') != 'RSA' or key.get('use', 'sig') != 'sig' or 'kid' not in key:
+                continue
+            keys[key['kid']] = jwk.construct(key, key.get('alg', ALGORITHMS[0]))
+
+        now = time.monotonic()
+        self.keys = keys
+        self.loaded = True
+        self.fetched_at = now
+        self.expires_at = now + (self.ttl if max_age is None else max_age)
+
+
+# ------------------------------
+# Key providers
+# ------------------------------
+
+class KeyProvider:
+    """Where the tokens come from: the issuer and audience they must have,
+    and the JWKS source of the keys that sign them."""
+
+    def __init__(self, domain, audience, jwks_source):
+        self.issuer = f'https://{domain}/'
+        self.audience = audience
+        self.jwks_source = jwks_source
+
+
+class LocalIssuer(KeyProvider):
+    """Stand-in for Auth0, for the tests and the benchmarks: an RSA key
+    generated in process, its JWKS, and tokens signed with it for any
+    permissions and expiry. Install it with set_key_provider."""
+
+    def __init__(self, domain='local.test', audience='local', kid='local-key', key_size=2048):
+        super().__init__(domain, audience, lambda: (self.jwks, None))
+        self.kid = kid
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+        self.private_pem = private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        )
+        public_pem = private_key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        public_key = jwk.construct(public_pem, ALGORITHMS[0]).to_dict()
+        public_key.update({'kid': kid, 'use': 'sig'})
+        self.jwks = {'keys': [public_key]}
+
+    # Signs a token with the permissions, expiring in expires_in seconds
+    # (negative for an expired one). claims are added to or replace the
+    # standard ones.
+    def mint(self, permissions=(), sub='local|user', expires_in=3600, **claims):
+        now = int(time.time())
+        payload = {
+            'iss': self.issuer,
+            'aud': self.audience,
+            'sub': sub,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self.private_pem, algorithm=ALGORITHMS[0], headers={'kid': self.kid})
+
+
+# The provider of the tokens, Auth0 unless set_key_provider is called
+key_provider = KeyProvider(AUTH0_DOMAIN, API_AUDIENCE, default_jwks_source())
+jwks_store = JWKSKeyStore(key_provider.jwks_source)
+
+# Verifies the tokens of provider from now on
+def set_key_provider(provider):
+    global key_provider
+    key_provider = provider
+    jwks_store.set_source(provider.jwks_source)
+    token_cache.clear()
+
+
+# ------------------------------
+# Verified token cache
+# ------------------------------
+
+class VerifiedTokenCache:
+    """Bounded LRU cache of verified JWT payloads keyed by a token digest.
+
+    An entry is only served until the token's exp claim and while the key
+    that signed it is still published in the JWKS.
+    """
+
+    def __init__(self, key_store, maxsize=TOKEN_CACHE_SIZE):
+        self.key_store = key_store
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        grants = self.get_grants(token)
+        return None if grants is None else grants.payload
+
+    # Gets the compiled grants of a verified token, or None
+    def get_grants(self, token):
+        digest = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                self._entries.move_to_end(digest)
+
+        if entry is not None:
+            grants, kid, exp = entry
+            if time.time() < exp and self._key_is_published(kid):
+                self.hits += 1
+                return grants
+            with self._lock:
+                self._entries.pop(digest, None)
+
+        self.misses += 1
+        return None
+
+    # Caches a verified payload, returns its grants
+    def set(self, token, payload, kid):
+        grants = Grants(payload)
+        # Tokens without an expiry are never cached
+        if not isinstance(payload.get('exp'), (int, float)):
+            return grants
+        digest = self.digest(token)
+        with self._lock:
+            self._entries[digest] = (grants, kid, payload['exp'])
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return grants
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "maxsize": self.maxsize
+        }
+
+    def _key_is_published(self, kid):
+        try:
+            return self.key_store.get_key(kid) is not None
+        except Exception:
+            return False
+
+
+token_cache = VerifiedTokenCache(jwks_store)
+
+
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    return verify_token(token).payload
+
+# Verifies the token, returns its grants
+def verify_token(token):
+    grants = token_cache.get_grants(token)
+    if grants is not None:
+        return grants
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
-        abort("Authorization malformed.")
-
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+        abort(401, "Authorization malformed.")
+
+    try:
+        with timed('jwks'):
+            rsa_key = jwks_store.get_key(unverified_header['kid'])
+    except Exception:
+        abort(500, "Unable to fetch the signing keys.")
+
     if rsa_key:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
                 algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                audience=key_provider.audience,
+                issuer=key_provider.issuer
             )
 
-            return payload
+            return token_cache.set(token, payload, unverified_header['kid'])
 
         except jwt.ExpiredSignatureError:
             abort(401, "Token expired.")
@@ -90,42 +530,31 @@ def verify_decode_jwt(token):
     abort(400, "Unable to find the appropriate key.")
 
 
-def requires_auth(permission=''):
+# Requires a valid token with permission and every permission in all_of, and
+# at least one of any_of when it is given. The requirement is compiled once
+# here, and each token's permissions once when it is verified.
+def requires_auth(permission='', any_of=(), all_of=()):
+    if isinstance(all_of, str):
+        all_of = (all_of,)
+    requirement = Requirement(((permission,) if permission else ()) + tuple(all_of), any_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            with timed('auth'):
+                token = get_token_auth_header()
+                grants = verify_token(token)
+                check_grants(requirement, grants)
+                client = token_client(grants.payload, token)
+                check_rate_limit(requirement.name, grants, client)
+            # Who sent the request and with which permission, for the
+            # replica routing, the audit log and the idempotency keys
+            g.grants = grants
+            g.token_subject = grants.payload.get('sub')
+            g.token_client = client
+            g.token_permission = requirement.name
+            return f(grants.payload, *args, **kwargs)
 
+        wrapper.requirement = requirement
         return wrapper
     return requires_auth_decorator
-
-
-# ------------------------------
-# Error handlers
-# ------------------------------
-@app.errorhandler(400)
-def autherror_400(error, message: str):
-    return jsonify({
-        "success": False,
-        'error': 400,
-        "message": message
-    }), 400
-
-@app.errorhandler(401)
-def autherror_401(error, message: str):
-    return jsonify({
-        "success": False,
-        'error': 404,
-        "message": message
-    }), 401
-
-@app.errorhandler(403)
-def autherror_403(error, message: str):
-    return jsonify({
-        "success": False,
-        'error': 403,
-        "message": message
-    }), 403
\ No newline at end of file
@@ -0,0 +1,332 @@
+"""Load tests every route of the API and records the results as JSON.
+
+Seeds a local database with actors, movies and casts, signs tokens with a
+LocalIssuer (installed as the app's key provider instead of Auth0), and runs the
+app in this process behind a threaded server. Each route is then driven by
+concurrent clients for a while, and its throughput, latency percentiles and
+database queries per request are reported. Runs can be saved with --output
+and compared with --compare.
+
+    python -m benchmarks.api --actors 5000 --movies 5000 --output before.json
+    python -m benchmarks.api --actors 5000 --movies 5000 --compare before.json
+
+Use --database-url to run against Postgres instead of SQLite. The tables are
+created with the migrations and the rows are added to whatever is there. Only
+the rows the benchmark added are updated or deleted.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+
+from benchmarks.common import local_issuer, run_load, wait_until_up
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIRST_NAMES = ['Ada', 'Bruno', 'Chloe', 'Diego', 'Elena', 'Farid', 'Grace', 'Hugo', 'Ines', 'Jonas']
+LAST_NAMES = ['Arden', 'Blake', 'Castillo', 'Dubois', 'Eriksen', 'Fontaine', 'Garcia', 'Haddad']
+TITLE_WORDS = ['Star', 'Night', 'River', 'Empire', 'Silent', 'Golden', 'Last', 'Storm', 'Garden', 'Code']
+SEARCHES = ['star', 'night riv', 'empre', 'garcia', 'ada', 'silent storm', 'golden']
+
+BATCH_SIZE = 100
+# Smaller, so the batch deletes don't run out of rows to delete
+DELETE_BATCH_SIZE = 10
+
+
+class Scenario:
+    """One route to load, and how to build each of its requests. created is
+    called with the body of each successful response."""
+
+    def __init__(self, name, method, rule, path, body=None, created=None):
+        self.name = name
+        self.method = method
+        self.rule = rule
+        self.path = path
+        self.body = body
+        self.created = created
+
+
+class SeededRows:
+    """The ids of the rows the benchmark added. The scenarios only update
+    and delete these, so other rows of a --database-url are left alone.
+    Rows to delete are taken from the pools, which the POST scenarios add
+    their rows to."""
+
+    def __init__(self, actors, movies, casts, deletable_actors, deletable_movies):
+        self.actors = actors
+        self.movies = movies
+        self.casts = deque(casts)
+        self.deletable_actors = deque(deletable_actors)
+        self.deletable_movies = deque(deletable_movies)
+
+    # Takes an id out of a pool. Once it's empty, 0, which no row has.
+    @staticmethod
+    def take(pool):
+        try:
+            return pool.popleft()
+        except IndexError:
+            return 0
+
+
+# Adds the ids of the rows a POST response created to pool
+def add_created(pool, key=None):
+    def add(data):
+        if key is not None:
+            pool.append(data[key]['id'])
+        else:
+            pool.extend(result['id'] for result in data['results'] if result['success'])
+    return add
+
+
+# Scenarios are run in this order, the writes after the reads so the reads
+# see the seeded data, and the deletes last
+def build_scenarios(rows):
+    random_actor = lambda: random.choice(rows.actors)
+    random_movie = lambda: random.choice(rows.movies)
+    deleted_actor = lambda: rows.take(rows.deletable_actors)
+    deleted_movie = lambda: rows.take(rows.deletable_movies)
+
+    def new_actor():
+        return {'name': f'{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}', 'age': random.randint(18, 90), 'gender': 'Female'}
+
+    def new_movie():
+        return {'title': f'{random.choice(TITLE_WORDS)} {random.choice(TITLE_WORDS)}', 'release_date': '2023-04-07T14:30:15'}
+
+    def uncast():
+        movie, actor = rows.take(rows.casts) or (0, 0)
+        return f'/movies/{movie}/actors/{actor}'
+
+    return [
+        Scenario('index', 'GET', '/', lambda: '/'),
+        Scenario('stats', 'GET', '/stats', lambda: '/stats'),
+        Scenario('metrics', 'GET', '/metrics', lambda: '/metrics'),
+        Scenario('list actors', 'GET', '/actors', lambda: f'/actors?after={random_actor() - 1}'),
+        Scenario('list movies', 'GET', '/movies', lambda: f'/movies?after={random_movie() - 1}'),
+        Scenario('list movies with casts', 'GET', '/movies', lambda: f'/movies?include=actors&after={random_movie() - 1}'),
+        Scenario('list movies as rows', 'GET', '/movies', lambda: f'/movies?format=rows&after={random_movie() - 1}'),
+        Scenario('get actor', 'GET', '/actors/<int:id>', lambda: f'/actors/{random_actor()}'),
+        Scenario('get movie', 'GET', '/movies/<int:id>', lambda: f'/movies/{random_movie()}'),
+        Scenario('get movie cast', 'GET', '/movies/<int:id>/actors', lambda: f'/movies/{random_movie()}/actors'),
+        Scenario('get actor movies', 'GET', '/actors/<int:id>/movies', lambda: f'/actors/{random_actor()}/movies'),
+        Scenario('search', 'GET', '/search', lambda: f'/search?q={quote(random.choice(SEARCHES))}'),
+        Scenario('changes', 'GET', '/changes', lambda: f'/changes?since={random.randint(0, len(rows.actors))}'),
+        Scenario('post actor', 'POST', '/actors', lambda: '/actors', new_actor, add_created(rows.deletable_actors, 'added_actor')),
+        Scenario('post movie', 'POST', '/movies', lambda: '/movies', new_movie, add_created(rows.deletable_movies, 'added_movie')),
+        Scenario('patch actor', 'PATCH', '/actors/<int:id>', lambda: f'/actors/{random_actor()}', lambda: {'age': random.randint(18, 90)}),
+        Scenario('patch movie', 'PATCH', '/movies/<int:id>', lambda: f'/movies/{random_movie()}', lambda: {'title': random.choice(TITLE_WORDS)}),
+        Scenario('put cast', 'PUT', '/movies/<int:movie_id>/actors/<int:actor_id>', lambda: f'/movies/{random_movie()}/actors/{random_actor()}', lambda: {'role': 'Lead', 'billing': 1}),
+        Scenario('post actors batch', 'POST', '/actors/batch', lambda: '/actors/batch', lambda: [new_actor() for _ in range(BATCH_SIZE)], add_created(rows.deletable_actors)),
+        Scenario('post movies batch', 'POST', '/movies/batch', lambda: '/movies/batch', lambda: [new_movie() for _ in range(BATCH_SIZE)], add_created(rows.deletable_movies)),
+        Scenario('patch actors batch', 'PATCH', '/actors/batch', lambda: '/actors/batch', lambda: [{'id': random_actor(), 'age': 40} for _ in range(BATCH_SIZE)]),
+        Scenario('patch movies batch', 'PATCH', '/movies/batch', lambda: '/movies/batch', lambda: [{'id': random_movie(), 'title': 'Batch'} for _ in range(BATCH_SIZE)]),
+        Scenario('delete cast', 'DELETE', '/movies/<int:movie_id>/actors/<int:actor_id>', uncast),
+        Scenario('delete actor', 'DELETE', '/actors/<int:id>', lambda: f'/actors/{deleted_actor()}'),
+        Scenario('delete movie', 'DELETE', '/movies/<int:id>', lambda: f'/movies/{deleted_movie()}'),
+        Scenario('delete actors batch', 'DELETE', '/actors/batch', lambda: '/actors/batch', lambda: [deleted_actor() for _ in range(DELETE_BATCH_SIZE)]),
+        Scenario('delete movies batch', 'DELETE', '/movies/batch', lambda: '/movies/batch', lambda: [deleted_movie() for _ in range(DELETE_BATCH_SIZE)])
+    ]
+
+
+# ------------------------------
+# Setup
+# ------------------------------
+
+def configure(directory, args):
+    database_url = args.database_url or f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+    os.environ.update(DATABASE_URL=database_url)
+    if args.no_cache:
+        os.environ.update(CACHE_SIZE='0', TOKEN_CACHE_SIZE='0')
+    sys.path.insert(0, ROOT)
+
+
+# Adds the rows of the benchmark, returns their SeededRows
+def seed(app, args):
+    from flask_migrate import upgrade
+    from models import bulk_insert, Actor, Movie, Cast
+
+    # The rows after the first args.actors and args.movies are for the deletes
+    extra = args.delete_pool
+    with app.app_context():
+        upgrade()
+        actors = [id for id, error in bulk_insert(Actor, [
+            {'name': f'{FIRST_NAMES[i % 10]} {LAST_NAMES[i % 8]} {i}', 'age': 18 + i % 70, 'gender': 'Female' if i % 2 else 'Male'}
+            for i in range(args.actors + extra)
+        ])]
+        start = datetime(1950, 1, 1)
+        movies = [id for id, error in bulk_insert(Movie, [
+            {'title': f'{TITLE_WORDS[i % 10]} {TITLE_WORDS[i // 10 % 10]} {i}', 'release_date': start + timedelta(days=i % 25000)}
+            for i in range(args.movies + extra)
+        ])]
+        cast = [
+            {'movie_id': movie, 'actor_id': actors[(i + offset * 7) % args.actors], 'role': f'Role {offset}', 'billing': offset + 1}
+            for i, movie in enumerate(movies[:args.movies])
+            for offset in range(args.cast_size)
+        ]
+        bulk_insert(Cast, cast)
+
+    casts = [(row['movie_id'], row['actor_id']) for row in cast]
+    return SeededRows(actors[:args.actors], movies[:args.movies], casts, actors[args.actors:], movies[args.movies:])
+
+
+def serve(app):
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Counts the queries sent to the database by the app
+class QueryCounter:
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self._increment)
+
+    def _increment(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+# ------------------------------
+# Running
+# ------------------------------
+
+def run_scenario(scenario, base_url, tokens, queries, args):
+    headers = {'Authorization': f'Bearer {tokens[scenario.method]}', 'Content-Type': 'application/json'}
+
+    def next_request(_):
+        body = json.dumps(scenario.body()).encode() if scenario.body else None
+        return scenario.method, scenario.path(), headers, body
+
+    def on_response(status, body):
+        if status < 300:
+            scenario.created(json.loads(body))
+
+    before = queries.count
+    result = run_load(base_url, next_request, args.concurrency, args.duration, on_response if scenario.created else None)
+    result['queries_per_request'] = (queries.count - before) / result['requests'] if result['requests'] else 0.0
+    return result
+
+
+# Lists the routes of the app no scenario drives
+def uncovered_routes(app, scenarios):
+    covered = {(scenario.rule, scenario.method) for scenario in scenarios}
+    routes = set()
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static':
+            continue
+        for method in rule.methods - {'HEAD', 'OPTIONS'}:
+            routes.add((rule.rule, method))
+    return sorted(routes - covered)
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_results(results, previous=None):
+    print(f"{'scenario':>24}  {'req/s':>8}  {'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}  {'queries':>7}  {'errors':>6}")
+    for name, result in results.items():
+        line = (f"{name:>24}  {result['requests_per_second']:8.1f}  {result['p50_ms']:8.1f}  "
+                f"{result['p95_ms']:8.1f}  {result['p99_ms']:8.1f}  {result['queries_per_request']:7.2f}  {result['errors']:6d}")
+        if previous and name in previous:
+            before = previous[name]
+            if before['requests_per_second']:
+                line += f"  req/s {(result['requests_per_second'] / before['requests_per_second'] - 1) * 100:+6.1f}%"
+            if before['p99_ms']:
+                line += f"  p99 {(result['p99_ms'] / before['p99_ms'] - 1) * 100:+6.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--actors', type=int, default=2000)
+    parser.add_argument('--movies', type=int, default=2000)
+    parser.add_argument('--cast-size', type=int, default=3, help='actors cast in each movie')
+    parser.add_argument('--delete-pool', type=int, default=20000, help='extra rows per table for the deletes')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=3, help='seconds per scenario')
+    parser.add_argument('--only', nargs='+', help='only run the scenarios with these names')
+    parser.add_argument('--database-url', help='database to seed and use instead of a temporary SQLite file')
+    parser.add_argument('--no-cache', action='store_true', help='turn off the read and token caches')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='a previous --output file to compare with')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random requests')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        configure(directory, args)
+        from app import create_app
+        from auth import set_key_provider
+        from models import db
+
+        issuer = local_issuer()
+        set_key_provider(issuer)
+
+        app = create_app()
+        rows = seed(app, args)
+        with app.app_context():
+            queries = QueryCounter(db.engine)
+
+        server = serve(app)
+        base_url = f'http://127.0.0.1:{server.server_port}'
+        wait_until_up(base_url + '/')
+
+        # Each method gets a token with only the permissions it needs, like a
+        # real client, so all of the reads share one cached token
+        tokens = {
+            'GET': issuer.mint(['get:actor', 'get:movie', 'get:stats']),
+            'POST': issuer.mint(['post:actor', 'post:movie']),
+            'PATCH': issuer.mint(['patch:actor', 'patch:movie']),
+            'PUT': issuer.mint(['patch:movie']),
+            'DELETE': issuer.mint(['delete:actor', 'delete:movie', 'patch:movie'])
+        }
+
+        scenarios = build_scenarios(rows)
+        missing = uncovered_routes(app, scenarios)
+        if missing:
+            print('Routes without a scenario:', ', '.join(f'{method} {rule}' for rule, method in missing))
+        if args.only:
+            scenarios = [scenario for scenario in scenarios if scenario.name in args.only]
+
+        results = {}
+        for scenario in scenarios:
+            results[scenario.name] = run_scenario(scenario, base_url, tokens, queries, args)
+        server.shutdown()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    print_results(results, previous)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'time': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'settings': {name: value for name, value in vars(args).items() if name not in ('output', 'compare')},
+                'results': results
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
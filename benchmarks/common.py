@@ -0,0 +1,133 @@
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+# Helpers shared by the benchmarks: a local token issuer standing in for
+# Auth0, a JWKS server, and a simple concurrent HTTP load generator.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ISSUER_DOMAIN = 'benchmark.local'
+AUDIENCE = 'benchmark'
+ALL_PERMISSIONS = [
+    'get:actor', 'get:movie',
+    'post:actor', 'post:movie',
+    'patch:actor', 'patch:movie',
+    'delete:actor', 'delete:movie'
+]
+
+
+# The app's stand-in for Auth0: a signing key generated in process, its JWKS
+# and a way to mint tokens with it. auth is only imported here, so call it
+# once the benchmark has set up the environment.
+def local_issuer(kid='benchmark-key'):
+    sys.path.insert(0, ROOT)
+    from auth import LocalIssuer
+    return LocalIssuer(ISSUER_DOMAIN, AUDIENCE, kid)
+
+
+# Serves jwks over HTTP in a background thread, waiting delay seconds before
+# each response. Returns the server and the JWKS URL.
+def serve_jwks(jwks, delay=0.0):
+    body = json.dumps(jwks).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/.well-known/jwks.json'
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+# Sends requests to base_url from concurrency threads for duration seconds.
+# next_request is called with the worker number and returns (method, path,
+# headers, body). on_response, if given, is called with the status and body of
+# each response, outside of its timing. Returns the throughput and latency
+# percentiles.
+def run_load(base_url, next_request, concurrency, duration, on_response=None):
+    address = urlsplit(base_url)
+    deadline = time.monotonic() + duration
+
+    def worker(number):
+        latencies = []
+        statuses = {}
+        errors = 0
+        connection = http.client.HTTPConnection(address.hostname, address.port, timeout=30)
+        while time.monotonic() < deadline:
+            method, path, headers, body = next_request(number)
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            except (OSError, http.client.HTTPException):
+                errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection(address.hostname, address.port, timeout=30)
+                continue
+            latencies.append(time.perf_counter() - start)
+            if on_response is not None:
+                on_response(response.status, data)
+        connection.close()
+        return latencies, statuses, errors
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(worker, range(concurrency)))
+    elapsed = time.monotonic() - start
+
+    latencies = [latency for worker_latencies, _, _ in results for latency in worker_latencies]
+    statuses = {}
+    for _, worker_statuses, _ in results:
+        for status, count in worker_statuses.items():
+            statuses[status] = statuses.get(status, 0) + count
+    return {
+        "requests": len(latencies),
+        "statuses": statuses,
+        "errors": sum(errors for _, _, errors in results) + sum(
+            count for status, count in statuses.items() if status >= 400
+        ),
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000
+    }
+
+
+# Waits until a GET of url answers
+def wait_until_up(url, timeout=30):
+    address = urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(address.hostname, address.port, timeout=1)
+            connection.request('GET', address.path or '/')
+            connection.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'{url} did not come up in {timeout} seconds')
@@ -0,0 +1,112 @@
+"""Measures how fast a 100k-row GET /movies response is serialized.
+
+Streams every movie as newline delimited JSON through the app (in process,
+so no network is involved) with each JSON backend, as objects and as
+format=rows arrays, and reports bytes and rows per second. Also times
+encoding the same rows alone with Flask's default provider, which is what
+the app used before.
+
+    python -m benchmarks.json_bench --rows 100000
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.common import ALL_PERMISSIONS, local_issuer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def create_app(directory, rows):
+    os.environ.update(
+        DATABASE_URL=f"sqlite:///{os.path.join(directory, 'benchmark.db')}",
+        CACHE_SIZE='0'
+    )
+    sys.path.insert(0, ROOT)
+    from flask_migrate import upgrade
+    from app import create_app
+    from models import bulk_insert, Movie
+
+    app = create_app()
+    with app.app_context():
+        upgrade()
+        start = datetime(1950, 1, 1)
+        bulk_insert(Movie, [
+            {'title': f'Movie {i}', 'release_date': start + timedelta(days=i % 20000)}
+            for i in range(rows)
+        ])
+    return app
+
+
+# Reads the whole response, returns (seconds, bytes)
+def time_response(client, path, headers):
+    start = time.perf_counter()
+    response = client.get(path, headers=headers, buffered=False)
+    size = sum(len(chunk) for chunk in response.response)
+    elapsed = time.perf_counter() - start
+    response.close()
+    assert response.status_code == 200, response.status_code
+    return elapsed, size
+
+
+def best_of(repeat, run):
+    return min((run() for _ in range(repeat)), key=lambda result: result[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(directory, args.rows)
+        from auth import set_key_provider
+        issuer = local_issuer()
+        set_key_provider(issuer)
+        headers = {'Authorization': f'Bearer {issuer.mint(ALL_PERMISSIONS)}', 'Accept': 'application/x-ndjson'}
+        from flask.json.provider import DefaultJSONProvider
+        from json_provider import FastJSONProvider, orjson
+        from models import db, Movie
+
+        results = {}
+        backends = ['json'] + (['orjson'] if orjson is not None else [])
+        client = app.test_client()
+        for backend in backends:
+            app.json = FastJSONProvider(app, backend=backend)
+            for format in ('objects', 'rows'):
+                elapsed, size = best_of(args.repeat, lambda: time_response(client, f'/movies?format={format}', headers))
+                results[f'stream {backend} {format}'] = {'seconds': elapsed, 'bytes': size}
+
+        # Encoding alone, without the query
+        with app.app_context():
+            rows = [dict(row._mapping) for row in db.session.execute(db.select(*Movie.__table__.columns))]
+        encoders = {'flask default': DefaultJSONProvider(app)}
+        encoders.update({backend: FastJSONProvider(app, backend=backend) for backend in backends})
+        for name, provider in encoders.items():
+            def encode():
+                start = time.perf_counter()
+                body = ''.join(provider.dumps(row) + '\n' for row in rows).encode()
+                return time.perf_counter() - start, len(body)
+            elapsed, size = best_of(args.repeat, encode)
+            results[f'encode {name}'] = {'seconds': elapsed, 'bytes': size}
+
+    for name, result in results.items():
+        result['bytes_per_second'] = result['bytes'] / result['seconds']
+        result['rows_per_second'] = args.rows / result['seconds']
+        print(f"{name:>22}: {result['bytes_per_second'] / 1e6:7.1f} MB/s  "
+              f"{result['rows_per_second']:10.0f} rows/s  "
+              f"{result['bytes'] / 1e6:6.1f} MB in {result['seconds'] * 1000:7.1f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
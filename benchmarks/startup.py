@@ -0,0 +1,112 @@
+"""Measures how long the app takes to start.
+
+Each measurement runs in a fresh Python process: the time to import app.py,
+to build the app with create_app(), and to answer the first request. The
+database URL points at a port nothing listens on, so any connection made at
+startup fails the run. Then gunicorn is started with and without preloading
+the app, and the time until it answers is measured.
+
+    python -m benchmarks.startup --budget-ms 1500
+
+With --budget-ms the exit status is 1 when importing and creating the app
+takes longer than the budget, so it can guard against regressions in CI.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.common import wait_until_up
+from benchmarks.workers import free_port
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Nothing listens on port 9, so connecting to this database fails right away
+UNREACHABLE_DATABASE_URL = 'postgresql://benchmark@127.0.0.1:9/benchmark'
+
+MEASURE = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+response = application.test_client().get('/')
+answered = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (answered - created) * 1000
+}))
+"""
+
+
+def measure_in_process(env):
+    result = subprocess.run([sys.executable, '-c', MEASURE], cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'Starting the app failed:\n{result.stderr}')
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure_gunicorn(env, workers, preload):
+    port = free_port()
+    env = dict(env, PORT=str(port), WEB_CONCURRENCY=str(workers), GUNICORN_PRELOAD=str(preload).lower())
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_until_up(f'http://127.0.0.1:{port}/')
+        return (time.perf_counter() - start) * 1000
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def summarize(samples):
+    return {
+        'median': statistics.median(samples),
+        'min': min(samples),
+        'max': max(samples)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--skip-gunicorn', action='store_true')
+    parser.add_argument('--budget-ms', type=float, help='fail if import and create_app take longer than this')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    env = dict(os.environ, DATABASE_URL=UNREACHABLE_DATABASE_URL, GUNICORN_WORKER_CLASS='gthread')
+
+    samples = [measure_in_process(env) for _ in range(args.repeat)]
+    results = {name: summarize([sample[name] for sample in samples]) for name in samples[0]}
+    results['startup_ms'] = summarize([sample['import_ms'] + sample['create_app_ms'] for sample in samples])
+
+    if not args.skip_gunicorn:
+        for preload in (True, False):
+            name = f"gunicorn_{'preload' if preload else 'no_preload'}_ms"
+            results[name] = summarize([measure_gunicorn(env, args.workers, preload) for _ in range(args.repeat)])
+
+    for name, result in results.items():
+        print(f"{name:>28}: median {result['median']:8.1f} ms  (min {result['min']:.1f}, max {result['max']:.1f})")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.budget_ms is not None and results['startup_ms']['median'] > args.budget_ms:
+        print(f"Startup took {results['startup_ms']['median']:.1f} ms, over the budget of {args.budget_ms:.1f} ms")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Compares gunicorn worker classes under concurrent load.
+
+Every request has to fetch the signing keys from a deliberately slow local
+JWKS server (the caches are turned off), which stands in for slow outbound
+I/O such as a sluggish Auth0 or Postgres. Sync workers hold the whole worker
+during each fetch, gthread and gevent workers keep serving other requests.
+
+    python -m benchmarks.workers --worker-classes sync gthread gevent
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.common import ALL_PERMISSIONS, AUDIENCE, ISSUER_DOMAIN, local_issuer, run_load, serve_jwks, wait_until_up
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def create_database(database_url, actors):
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, ROOT)
+    from flask import Flask
+    from flask_migrate import upgrade
+    from models import setup_db, bulk_insert, Actor
+
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    with app.app_context():
+        upgrade()
+        bulk_insert(Actor, [{'name': f'Actor {i}', 'age': 30, 'gender': 'Female'} for i in range(actors)])
+
+
+def bench_worker_class(worker_class, args, env):
+    port = free_port()
+    env = dict(env, PORT=str(port), GUNICORN_WORKER_CLASS=worker_class)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        base_url = f'http://127.0.0.1:{port}'
+        wait_until_up(base_url + '/')
+        headers = {'Authorization': f'Bearer {args.token}'}
+        if not args.keepalive:
+            # Like most routers in front of gunicorn, open a connection per request
+            headers['Connection'] = 'close'
+        return run_load(base_url, lambda _: ('GET', args.path, headers, None), args.concurrency, args.duration)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--worker-classes', nargs='+', default=['sync', 'gthread', 'gevent'])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--jwks-delay', type=float, default=50, help='milliseconds per JWKS fetch')
+    parser.add_argument('--path', default='/actors/1')
+    parser.add_argument('--keepalive', action='store_true', help='reuse client connections')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    # The gunicorn workers are other processes, so they get the issuer's keys
+    # from a JWKS server like they would from Auth0
+    issuer = local_issuer()
+    args.token = issuer.mint(ALL_PERMISSIONS)
+    jwks_server, jwks_url = serve_jwks(issuer.jwks, delay=args.jwks_delay / 1000)
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        create_database(database_url, actors=100)
+        env = dict(
+            os.environ,
+            DATABASE_URL=database_url,
+            AUTH0_DOMAIN=ISSUER_DOMAIN,
+            API_AUDIENCE=AUDIENCE,
+            JWKS_URL=jwks_url,
+            JWKS_CACHE_TTL='0',
+            JWKS_STALE_TTL='0',
+            TOKEN_CACHE_SIZE='0',
+            CACHE_SIZE='0',
+            WEB_CONCURRENCY=str(args.workers),
+            GUNICORN_THREADS=str(args.threads)
+        )
+
+        results = {}
+        for worker_class in args.worker_classes:
+            results[worker_class] = bench_worker_class(worker_class, args, env)
+            print(f"{worker_class:>8}: {results[worker_class]['requests_per_second']:8.1f} req/s  "
+                  f"p50 {results[worker_class]['p50_ms']:7.1f} ms  "
+                  f"p99 {results[worker_class]['p99_ms']:7.1f} ms  "
+                  f"errors {results[worker_class]['errors']}")
+
+    jwks_server.shutdown()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from json_provider import decode, encode
+
+# Entries kept in each worker's memory, and how long entries live (seconds)
+CACHE_SIZE = int(os.getenv('CACHE_SIZE', 1024))
+CACHE_TTL = int(os.getenv('CACHE_TTL', 300))
+
+
+# ------------------------------
+# Shared backends
+# ------------------------------
+
+class CacheBackend:
+    """Interface of the cache shared by all of the workers."""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+
+class LocalBackend(CacheBackend):
+    """In-process stand-in for a shared backend, used by the tests."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisBackend(CacheBackend):
+    """Shared backend on a Redis server. Needs the redis package.
+
+    Values are stored as JSON, never unpickled, so whoever can write to the
+    server can't run code in the workers. They come back with JSON's types:
+    lists for tuples and ISO 8601 strings for datetimes, which are written
+    the same way in the responses.
+    """
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis package is needed to use a redis:// CACHE_URL.')
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else decode(value)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, encode(value), ex=ttl)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+# Gets the shared backend configured by CACHE_URL, or None
+def backend_from_url(url):
+    if not url:
+        return None
+    if url == 'local://':
+        return LocalBackend()
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisBackend(url)
+    raise ValueError(f'Unsupported CACHE_URL: {url}')
+
+
+# ------------------------------
+# Read-through cache
+# ------------------------------
+
+class ReadThroughCache:
+    """Two tier read-through cache: an LRU in the worker's memory, in front of
+    an optional backend shared by all of the workers.
+
+    Keys are expected to contain the version of the data they were loaded
+    from, so a write only has to bump the version for the old entries to stop
+    being read. They are then evicted by the LRU and the TTL.
+    """
+
+    def __init__(self, backend=None, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.backend = backend
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Gets the value of key, calling load to get it on a miss. None values
+    # aren't cached.
+    def get(self, key, load):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.local_hits += 1
+                return entry[1]
+
+        if self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self.shared_hits += 1
+                self._store(key, value)
+                return value
+
+        self.misses += 1
+        value = load()
+        if value is not None:
+            self._store(key, value)
+            if self.backend is not None:
+                self.backend.set(key, value, self.ttl)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.local_hits = 0
+            self.shared_hits = 0
+            self.misses = 0
+
+    def stats(self):
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": (self.local_hits + self.shared_hits) / lookups if lookups else 0.0,
+            "size": len(self._entries),
+            "maxsize": self.maxsize
+        }
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+read_cache = ReadThroughCache(backend_from_url(os.getenv('CACHE_URL')))
@@ -0,0 +1,267 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import AuditEntry, Change, RoutingSession, db
+
+logger = logging.getLogger(__name__)
+
+# Longest a GET /changes request can wait for a change (seconds)
+CHANGES_MAX_WAIT = int(os.getenv('CHANGES_MAX_WAIT', 30))
+
+# How often waiting requests look for changes committed by other workers.
+# Changes committed by the same worker wake them up right away.
+CHANGES_POLL_INTERVAL = float(os.getenv('CHANGES_POLL_INTERVAL', 1))
+
+# How long an event stream stays open before the client has to reconnect
+CHANGES_STREAM_SECONDS = int(os.getenv('CHANGES_STREAM_SECONDS', 300))
+
+# Seconds between the comments sent on an idle event stream
+KEEPALIVE_INTERVAL = 15
+
+# Gets the default of CHANGES_MAX_WAITERS. Each waiting request holds one of
+# a gthread worker's threads (see gunicorn.conf.py), so by default only half
+# of them can wait. A gevent worker can hold many more.
+def default_max_waiters():
+    if os.getenv('GUNICORN_WORKER_CLASS') == 'gevent':
+        return int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 200)) // 2
+    return max(1, int(os.getenv('GUNICORN_THREADS', 8)) // 2)
+
+# Requests of each worker that can wait for changes or stream them at once.
+# More get a 503 error.
+CHANGES_MAX_WAITERS = int(os.getenv('CHANGES_MAX_WAITERS', default_max_waiters()))
+
+# Entries waiting to be written to the audit log, and how many are written
+# per transaction
+AUDIT_QUEUE_SIZE = int(os.getenv('AUDIT_QUEUE_SIZE', 10000))
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', 500))
+
+# Seconds to keep writing the queued entries when the process exits
+AUDIT_FLUSH_TIMEOUT = float(os.getenv('AUDIT_FLUSH_TIMEOUT', 5))
+
+
+# ------------------------------
+# Change feed
+# ------------------------------
+
+class ChangeNotifier:
+    """Wakes up the requests waiting for changes when this process commits
+    some. Changes committed by other workers are found by polling."""
+
+    def __init__(self):
+        self.last_id = 0
+        self._condition = threading.Condition()
+
+    def notify(self, last_id):
+        with self._condition:
+            self.last_id = max(self.last_id, last_id)
+            self._condition.notify_all()
+
+    # Waits up to timeout seconds for a commit after the one whose last id
+    # was seen. Returns the last id now.
+    def wait(self, seen, timeout):
+        with self._condition:
+            if self.last_id == seen:
+                self._condition.wait(timeout)
+            return self.last_id
+
+
+notifier = ChangeNotifier()
+
+
+class WaiterLimit:
+    """Counts the requests of this process waiting for changes, so they
+    can't take every thread of the worker."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.waiting = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    # Returns whether the request can wait, call release once it's done
+    def acquire(self):
+        with self._lock:
+            if self.waiting >= self.limit:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def stats(self):
+        return {
+            "waiting": self.waiting,
+            "limit": self.limit,
+            "rejected": self.rejected
+        }
+
+
+waiters = WaiterLimit(CHANGES_MAX_WAITERS)
+
+
+# Gets up to limit changes to the tables after the change with id since
+def get_changes(since, tables, limit):
+    query = (
+        db.select(Change)
+        .where(Change.id > since, Change.table_name.in_(tables))
+        .order_by(Change.id)
+        .limit(limit)
+    )
+    return [change.format() for change in db.session.execute(query).scalars()]
+
+# Gets the changes after since, waiting up to wait seconds for one. The
+# database connection is given back to the pool while waiting.
+def wait_for_changes(since, tables, limit, wait):
+    deadline = time.monotonic() + wait
+    while True:
+        seen = notifier.last_id
+        changes = get_changes(since, tables, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        db.session.close()
+        notifier.wait(seen, min(CHANGES_POLL_INTERVAL, remaining))
+
+# Yields the changes after since as server-sent events, for
+# CHANGES_STREAM_SECONDS. The id of each event is the id of the change, which
+# the client sends back in Last-Event-ID when it reconnects.
+def change_events(since, tables, limit):
+    deadline = time.monotonic() + CHANGES_STREAM_SECONDS
+    while time.monotonic() < deadline:
+        changes = wait_for_changes(since, tables, limit, min(KEEPALIVE_INTERVAL, deadline - time.monotonic()))
+        db.session.close()
+        if changes:
+            since = changes[-1]['id']
+            yield ''.join(
+                f"id: {change['id']}\nevent: change\ndata: {current_app.json.dumps(change)}\n\n"
+                for change in changes
+            )
+        else:
+            # Keeps proxies from closing an idle stream
+            yield ': keepalive\n\n'
+
+
+# ------------------------------
+# Audit log
+# ------------------------------
+
+class AuditQueue:
+    """Writes the audit entries in batches from a background thread, so the
+    requests don't wait for them.
+
+    Entries are dropped when the queue is full, and the ones still queued
+    when the process is killed are lost. Each process starts its own thread
+    on first use, so it also works in workers forked from a preloaded app.
+    """
+
+    def __init__(self, app, maxsize=AUDIT_QUEUE_SIZE, batch_size=AUDIT_BATCH_SIZE):
+        self.app = app
+        self.batch_size = batch_size
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def put(self, entry):
+        self._start()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    # Waits up to timeout seconds for the queued entries to be written.
+    # Returns whether they all were.
+    def flush(self, timeout=AUDIT_FLUSH_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed
+        }
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='audit-queue', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            entries = [self._queue.get()]
+            while len(entries) < self.batch_size:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(entries)
+            for _ in entries:
+                self._queue.task_done()
+
+    def _write(self, entries):
+        try:
+            with self.app.app_context():
+                db.session.execute(db.insert(AuditEntry), entries)
+                db.session.commit()
+            self.written += len(entries)
+        except SQLAlchemyError:
+            self.failed += len(entries)
+            logger.exception('Could not write %d audit log entries', len(entries))
+
+
+# Wakes up the waiting requests and queues the audit entry of every commit
+# that wrote changes
+@event.listens_for(RoutingSession, 'after_commit')
+def _changes_committed(session):
+    if session.in_nested_transaction():
+        return
+    committed = session.info.pop('committed', None)
+    if committed is None:
+        return
+
+    first, last = committed
+    notifier.notify(last)
+    audit = current_app.extensions.get('audit') if has_request_context() else None
+    if audit is not None:
+        audit.put({
+            "first_change_id": first,
+            "last_change_id": last,
+            "subject": g.get('token_subject'),
+            "permission": g.get('token_permission'),
+            "method": request.method,
+            "path": request.path,
+            "remote_addr": request.remote_addr,
+            "created_at": datetime.utcnow()
+        })
+
+
+# Writes the audit log of app's requests in the background. Call it after
+# setup_db.
+def init_audit(app):
+    app.extensions['audit'] = AuditQueue(app)
+    return app.extensions['audit']
@@ -0,0 +1,150 @@
+import os
+import zlib
+from flask import request
+
+from instrumentation import timed
+
+# brotli and zstandard are optional, gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Responses smaller than this many bytes are sent as they are, since the
+# headers and the CPU cost more than compression saves. Streamed responses
+# have no known size and are always compressed. 0 turns compression off.
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+
+# Compression level of each encoding, higher is smaller but slower
+GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+BROTLI_LEVEL = int(os.getenv('COMPRESS_BROTLI_LEVEL', 4))
+ZSTD_LEVEL = int(os.getenv('COMPRESS_ZSTD_LEVEL', 3))
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+
+
+# ------------------------------
+# Compressors
+# ------------------------------
+# Each compressor takes the body in chunks. flush() returns everything the
+# client needs to decode the chunks so far, so each chunk of a stream goes out
+# right away, and finish() ends the body.
+
+class GzipCompressor:
+    def __init__(self):
+        self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_LEVEL)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH)
+
+
+# Available encodings, in order of preference when the client accepts several
+# equally
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS['zstd'] = ZstdCompressor
+if brotli is not None:
+    COMPRESSORS['br'] = BrotliCompressor
+COMPRESSORS['gzip'] = GzipCompressor
+
+
+# Gets the encoding to compress the current response with, from the request's
+# Accept-Encoding header, or None
+def negotiate_encoding():
+    if COMPRESS_MIN_SIZE <= 0:
+        return None
+    return request.accept_encodings.best_match(list(COMPRESSORS)) or None
+
+
+# ------------------------------
+# After request
+# ------------------------------
+
+# Compresses JSON responses with the best encoding the client accepts.
+# Registered with app.after_request.
+def compress_response(response):
+    if COMPRESS_MIN_SIZE <= 0:
+        return response
+    if response.status_code == 304:
+        response.vary.add('Accept-Encoding')
+        return response
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.status_code < 200 or response.status_code == 204
+            or 'Content-Encoding' in response.headers
+            or response.direct_passthrough
+            or request.method == 'HEAD'):
+        return response
+
+    # The body depends on the header whether or not this one is compressed
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    compressor = COMPRESSORS[encoding]()
+    if response.is_streamed:
+        response.response = compress_stream(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        with timed('compress'):
+            response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# Compresses each chunk of a streamed body as soon as it is produced
+def compress_stream(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -0,0 +1,378 @@
+import contextlib
+import csv
+import itertools
+import os
+import sys
+import time
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import BULK_CHUNK_SIZE, Actor, Cast, Change, Movie, TableStats, bulk_insert, db, validate
+
+# The tables that can be imported, like POST '/actors' and POST '/movies',
+# and exported
+IMPORT_MODELS = {'actors': Actor, 'movies': Movie}
+EXPORT_MODELS = {'actors': Actor, 'movies': Movie, 'cast': Cast}
+
+FORMATS = ('csv', 'jsonl')
+EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+# Rows between the progress reports
+PROGRESS_INTERVAL = 100000
+
+# Invalid rows printed before only counting them
+MAX_REPORTED_ERRORS = 10
+
+# Bytes read from the rows at a time by COPY
+COPY_BUFFER_SIZE = 1 << 16
+
+data_cli = AppGroup('data', help='Imports and exports the actors and movies as CSV or JSON Lines.')
+
+
+# ------------------------------
+# Rows
+# ------------------------------
+
+# Gets the format of path from its extension, unless it is given
+def get_format(path, format):
+    if format is not None:
+        return format
+    format = EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if format is None:
+        raise click.UsageError(f'Cannot tell the format of {path}, use --format.')
+    return format
+
+# Opens path for CSV, or stdin or stdout for -
+def open_path(path, mode):
+    if path == '-':
+        return contextlib.nullcontext(sys.stdin if mode == 'r' else sys.stdout)
+    return open(path, mode, encoding='utf-8', newline='')
+
+# Yields (line number, data) for the rows of a CSV file with a header, or of
+# a JSON Lines file. Empty CSV cells are None.
+def read_rows(file, format):
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, {field: None if value == '' else value for field, value in row.items()}
+    else:
+        for number, line in enumerate(file, 1):
+            if line.strip():
+                yield number, line
+
+# Gets a function turning a row read from a file of format into the data
+# the API would have gotten for model
+def row_parser(model, format):
+    if format == 'jsonl':
+        def parse(line):
+            try:
+                return current_app.json.loads(line)
+            except ValueError:
+                raise ValueError('Invalid JSON.')
+        return parse
+
+    # CSV cells are text, integers are parsed here as JSON would have them
+    integers = {column.key for column in model.__table__.columns if isinstance(column.type, db.Integer)}
+
+    def parse(row):
+        for field in integers & row.keys():
+            try:
+                row[field] = int(row[field]) if row[field] is not None else None
+            except ValueError:
+                pass
+        return row
+    return parse
+
+# Checks that the values fit model's columns, so the database doesn't reject
+# a whole COPY for one row. Raises ValueError if they don't.
+def check_columns(model, values):
+    for field, value in values.items():
+        column = model.__table__.columns[field]
+        if value is None:
+            if not column.nullable:
+                raise ValueError(f'Missing {field}.')
+        elif isinstance(column.type, db.Integer):
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ValueError(f'Expected an integer {field}.')
+        elif isinstance(column.type, db.String):
+            if not isinstance(value, str):
+                raise ValueError(f'Expected a string {field}.')
+    return values
+
+
+class Progress:
+    """Counts the rows of an import or export and reports them on stderr."""
+
+    def __init__(self, table, verb):
+        self.table = table
+        self.verb = verb
+        self.read = 0
+        self.invalid = 0
+        self.rejected = 0
+        self.written = 0
+        self._start = time.monotonic()
+
+    def row_read(self):
+        self.read += 1
+        if self.read % PROGRESS_INTERVAL == 0:
+            click.echo(f'{self.table}: {self.read} rows so far ({self.read / self.elapsed():.0f} rows/s)', err=True)
+
+    def row_invalid(self, number, error):
+        self.invalid += 1
+        if self.invalid <= MAX_REPORTED_ERRORS:
+            click.echo(f'{self.table}: line {number}: {error}', err=True)
+
+    def elapsed(self):
+        return max(time.monotonic() - self._start, 1e-9)
+
+    def summary(self):
+        summary = f'{self.table}: {self.written} rows {self.verb} in {self.elapsed():.1f} s ({self.written / self.elapsed():.0f} rows/s)'
+        if self.invalid:
+            summary += f', {self.invalid} invalid rows skipped'
+        if self.rejected:
+            summary += f', {self.rejected} rows rejected by the database'
+        return summary
+
+
+# Yields the validated values of the rows, with the same rules as the POST
+# routes. Invalid rows are reported and skipped.
+def validate_rows(model, rows, parse, progress):
+    for number, row in rows:
+        progress.row_read()
+        try:
+            yield check_columns(model, validate(model, parse(row)))
+        except ValueError as e:
+            progress.row_invalid(number, e)
+
+
+# ------------------------------
+# Import
+# ------------------------------
+
+# Encodes values as a line of COPY's CSV format, where an unquoted empty
+# value is NULL and a quoted one an empty string
+def copy_line(values):
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append('')
+        elif isinstance(value, str):
+            cells.append('"' + value.replace('"', '""') + '"')
+        elif isinstance(value, datetime):
+            cells.append(value.isoformat())
+        else:
+            cells.append(str(value))
+    return ','.join(cells) + '\n'
+
+
+class CopyStream:
+    """File-like object reading lines from an iterator, for COPY FROM STDIN.
+    Only a chunk of the lines is in memory at a time."""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = ''.join(itertools.islice(self._lines, 1000))
+            if not chunk:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class CopyOutput:
+    """Writes what COPY TO STDOUT gives, bytes or text, to a text file."""
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        self.file.write(data.decode() if isinstance(data, bytes) else data)
+
+
+def quote(name):
+    return db.engine.dialect.identifier_preparer.quote(name)
+
+# The SQL of a datetime column written as text like Python writes it, with
+# the microseconds only when there are some
+def datetime_sql(name, separator):
+    return (
+        f"to_char({name}, 'YYYY-MM-DD{separator}HH24:MI:SS') "
+        f"|| CASE WHEN mod(date_part('microseconds', {name})::integer, 1000000) <> 0 "
+        f"THEN to_char({name}, '.US') ELSE '' END"
+    )
+
+# The SQL of a column's value in the data of a change, written like
+# _jsonable writes it: datetimes in ISO 8601 in UTC
+def change_value_sql(column):
+    name = quote(column.name)
+    if isinstance(column.type, db.DateTime):
+        return datetime_sql(name, '"T"') + " || '+00:00'"
+    return name
+
+# The SQL of a column's value in an export, written like the csv module
+# writes it
+def export_value_sql(column):
+    name = quote(column.name)
+    if isinstance(column.type, db.DateTime):
+        return f'{datetime_sql(name, " ")} AS {name}'
+    return name
+
+# Copies the values to model's table in one transaction. The rows go through
+# a temporary table, then are inserted with their changes by a single INSERT.
+# Returns the number of rows written.
+def copy_rows(model, values):
+    table = quote(model.__tablename__)
+    fields = ', '.join(quote(field) for field in model.fields)
+    changes = ', '.join(f"'{column.name}', {change_value_sql(column)}" for column in model.__table__.columns)
+
+    # The rows are counted as they are sent, the rowcount of COPY depends on
+    # the driver's version
+    count = 0
+
+    def lines():
+        nonlocal count
+        for row in values:
+            count += 1
+            yield copy_line(row[field] for field in model.fields)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.execute(f'CREATE TEMPORARY TABLE import_rows ON COMMIT DROP AS SELECT {fields} FROM {table} WITH NO DATA')
+        cursor.copy_expert(f'COPY import_rows ({fields}) FROM STDIN WITH (FORMAT csv)', CopyStream(lines()), COPY_BUFFER_SIZE)
+        if count > 0:
+            first = Change.reserve(count) - count + 1
+            cursor.execute(
+                f'WITH inserted AS (INSERT INTO {table} ({fields}) SELECT {fields} FROM import_rows RETURNING *) '
+                'INSERT INTO changes (id, table_name, row_id, operation, data, changed_at) '
+                f"SELECT %s - 1 + row_number() OVER (ORDER BY id), %s, id, 'insert', json_build_object({changes}), %s "
+                'FROM inserted',
+                (first, model.__tablename__, datetime.utcnow())
+            )
+            TableStats.bump(model, count)
+    finally:
+        cursor.close()
+    db.session.commit()
+    return count
+
+# Inserts the values in transactions of BULK_CHUNK_SIZE rows, like the batch
+# routes. Returns the number of rows written and rejected.
+def insert_rows(model, values):
+    written = rejected = 0
+    while True:
+        chunk = list(itertools.islice(values, BULK_CHUNK_SIZE))
+        if not chunk:
+            return written, rejected
+        for id, error in bulk_insert(model, chunk):
+            if error is None:
+                written += 1
+            else:
+                rejected += 1
+
+
+# Whether to use COPY: on Postgres unless --no-copy is given. --copy on
+# another database is an error rather than silently ignored.
+def use_copy(copy):
+    postgres = db.engine.dialect.name == 'postgresql'
+    if copy and not postgres:
+        raise click.UsageError('--copy needs a Postgres database.')
+    return postgres if copy is None else copy
+
+
+@data_cli.command('import')
+@click.argument('table', type=click.Choice(sorted(IMPORT_MODELS)))
+@click.argument('path', type=click.Path(allow_dash=True, dir_okay=False))
+@click.option('--format', type=click.Choice(FORMATS), help='Format of the file, by default from its extension.')
+@click.option('--copy/--no-copy', default=None,
+              help='Stream the rows with COPY in one transaction (the default on Postgres), '
+                   'or insert them in transactions of BULK_CHUNK_SIZE rows.')
+def import_command(table, path, format, copy):
+    """Adds the actors or movies of a CSV or JSON Lines file.
+
+    Each row is validated like the body of POST '/actors' or POST
+    '/movies', ids are given by the database. Invalid rows are skipped and
+    reported, and the exit status is 1 if there were any. On Postgres the
+    rows are streamed with COPY in a single transaction, so a row the
+    database rejects rolls back the whole import. Elsewhere, or with
+    --no-copy, they are inserted in transactions of BULK_CHUNK_SIZE rows and
+    the rejected rows are counted.
+    """
+    model = IMPORT_MODELS[table]
+    format = get_format(path, format)
+    copy = use_copy(copy)
+    progress = Progress(table, 'imported')
+    with open_path(path, 'r') as file:
+        values = validate_rows(model, read_rows(file, format), row_parser(model, format), progress)
+        if copy:
+            progress.written = copy_rows(model, values)
+        else:
+            progress.written, progress.rejected = insert_rows(model, values)
+
+    click.echo(progress.summary(), err=True)
+    if progress.invalid or progress.rejected:
+        sys.exit(1)
+
+
+# ------------------------------
+# Export
+# ------------------------------
+
+@data_cli.command('export')
+@click.argument('table', type=click.Choice(sorted(EXPORT_MODELS)))
+@click.argument('path', type=click.Path(allow_dash=True, dir_okay=False), default='-')
+@click.option('--format', type=click.Choice(FORMATS), help='Format of the file, by default from its extension.')
+@click.option('--copy/--no-copy', default=None,
+              help='Write CSV with COPY (the default on Postgres), or from a query.')
+def export_command(table, path, format, copy):
+    """Writes the rows of a table, ordered by id, as CSV with a header or as
+    JSON Lines. PATH defaults to stdout, which is written as JSON Lines
+    unless --format is given.
+
+    The rows are streamed, so memory use doesn't grow with the table. On
+    Postgres the CSV is written by COPY, unless --no-copy is given.
+    """
+    model = EXPORT_MODELS[table]
+    format = get_format(path, format or ('jsonl' if path == '-' else None))
+    if copy and format != 'csv':
+        raise click.UsageError('--copy only writes CSV.')
+    copy = use_copy(copy) and format == 'csv'
+    columns = list(model.__table__.columns)
+    progress = Progress(table, 'exported')
+
+    with open_path(path, 'w') as file:
+        if copy:
+            names = ', '.join(export_value_sql(column) for column in columns)
+            cursor = db.session.connection().connection.cursor()
+            try:
+                cursor.copy_expert(
+                    f'COPY (SELECT {names} FROM {quote(model.__tablename__)} ORDER BY id) TO STDOUT WITH (FORMAT csv, HEADER)',
+                    CopyOutput(file), COPY_BUFFER_SIZE
+                )
+                progress.written = cursor.rowcount
+            finally:
+                cursor.close()
+        else:
+            rows = db.session.execute(
+                db.select(*columns).order_by(model.__table__.c.id).execution_options(yield_per=BULK_CHUNK_SIZE)
+            )
+            if format == 'csv':
+                writer = csv.writer(file, lineterminator='\n')
+                writer.writerow(column.name for column in columns)
+            for row in rows:
+                if format == 'csv':
+                    writer.writerow(row)
+                else:
+                    file.write(current_app.json.dumps(dict(row._mapping)) + '\n')
+                progress.written += 1
+                progress.row_read()
+        db.session.rollback()
+
+    click.echo(progress.summary(), err=True)
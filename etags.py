@@ -0,0 +1,45 @@
+import hashlib
+from functools import wraps
+from flask import request, make_response
+
+from models import TableStats
+from compression import negotiate_encoding
+
+# Responses can be stored by the client, but have to be revalidated with the
+# ETag before every reuse since the data can change at any time
+CACHE_CONTROL = 'private, no-cache'
+
+
+# Computes the ETag of a GET request from the versions of the tables it reads.
+# Compressed and uncompressed bodies differ, so the encoding is part of it.
+def compute_etag(models):
+    versions = ','.join(f'{model.__tablename__}:{TableStats.get(model).version}' for model in models)
+    accept = request.accept_mimetypes.to_header()
+    key = f'{request.full_path}|{accept}|{negotiate_encoding()}|{versions}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+# Adds a strong ETag to the responses of a read route, and answers with
+# 304 Not Modified when the client already has the current version. Goes
+# below requires_auth so only authorized clients get a 304. depends can return
+# more models the current request reads, like the includes of a list.
+def conditional(*models, depends=None):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            read = models + tuple(depends()) if depends else models
+            etag = compute_etag(read)
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = CACHE_CONTROL
+            response.vary.update(('Accept', 'Authorization'))
+            return response
+
+        return wrapper
+    return conditional_decorator
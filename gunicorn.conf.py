@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+
+# Gunicorn settings, read by `gunicorn -c gunicorn.conf.py app:app`.
+#
+# The default gthread workers serve several requests at once per worker, so a
+# slow query or JWKS fetch only holds up one thread. Set
+# GUNICORN_WORKER_CLASS=gevent for many more concurrent requests per worker
+# (needs the gevent and psycogreen packages), or sync for the old behavior.
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+# Tell the app how many workers share the load, for the settings that need
+# a CACHE_URL with more than one
+os.environ['WEB_CONCURRENCY'] = str(workers)
+
+# Threads per gthread worker (gunicorn turns sync workers with more than one
+# thread into gthread workers), and open connections per gevent worker
+threads = int(os.getenv('GUNICORN_THREADS', 8)) if worker_class == 'gthread' else 1
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 200))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+# Load the app once in the master, so each worker starts as a fork of it
+# instead of importing everything again. Not for gevent workers: they patch
+# threading after the fork, and locks the app created before it would block
+# the whole worker instead of one greenlet.
+preload_app = os.getenv('GUNICORN_PRELOAD', 'false' if worker_class == 'gevent' else 'true').lower() in ('1', 'true', 'yes', 'on')
+
+# Give every thread its own database connection. Greenlets wait for a pooled
+# connection, so gevent workers keep the default pool and overflow.
+if worker_class == 'gthread':
+    os.environ.setdefault('DB_POOL_SIZE', str(threads))
+
+
+def post_fork(server, worker):
+    if preload_app:
+        # Connections opened in the master can't be shared with the workers,
+        # drop them from each worker's pool without closing them
+        from app import app
+        from models import db
+        with app.app_context():
+            engines = list(db.engines.values())
+        router = app.extensions.get('replicas')
+        if router is not None:
+            engines += [replica.engine for replica in router.replicas]
+        for engine in engines:
+            engine.dispose(close=False)
+
+    if worker_class == 'gevent':
+        # psycopg2 is a C extension, without this a query blocks every
+        # greenlet in the worker
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
@@ -0,0 +1,329 @@
+import base64
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app, g, request, abort
+from sqlalchemy.exc import IntegrityError
+
+from models import IdempotencyKey, db, get_setting
+
+logger = logging.getLogger(__name__)
+
+# The request header holding the client's key for a write
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+# The headers of a response that are stored with it and replayed
+STORED_HEADERS = ('Content-Type', 'Location', 'ETag', 'Last-Modified')
+
+# Seconds between the deletions of the expired keys from the database, per worker
+CLEANUP_INTERVAL = 60
+
+
+class StoredRequest:
+    """What is stored for a key: the fingerprint of the request that used it,
+    and its response as (status code, [(header, value)], body), or None while
+    that request is running."""
+
+    __slots__ = ('fingerprint', 'response')
+
+    def __init__(self, fingerprint, response=None):
+        self.fingerprint = fingerprint
+        self.response = response
+
+    # As JSON with the body in base64, for the backends outside the process
+    def dumps(self):
+        response = None
+        if self.response is not None:
+            status_code, headers, body = self.response
+            response = [status_code, headers, base64.b64encode(body).decode()]
+        return json.dumps([self.fingerprint, response])
+
+    @classmethod
+    def loads(cls, data):
+        fingerprint, response = json.loads(data)
+        if response is not None:
+            status_code, headers, body = response
+            response = (status_code, [tuple(header) for header in headers], base64.b64decode(body))
+        return cls(fingerprint, response)
+
+
+# ------------------------------
+# Backends
+# ------------------------------
+
+class IdempotencyBackend:
+    """Interface of the storage of the keys, which are digests of the client
+    and its Idempotency-Key."""
+
+    # Reserves key for the request with fingerprint for lock_timeout seconds.
+    # Returns None if it was free, or what is stored for it.
+    def reserve(self, key, fingerprint, lock_timeout):
+        raise NotImplementedError
+
+    # Stores the response of the request holding key for ttl seconds
+    def save(self, key, fingerprint, response, ttl):
+        raise NotImplementedError
+
+    # Frees key, so the request can be sent again
+    def release(self, key):
+        raise NotImplementedError
+
+
+class LocalIdempotencyBackend(IdempotencyBackend):
+    """Keys in the worker's memory, used by the tests. With several workers a
+    retry sent to another worker isn't recognized. The least recently used
+    keys are dropped past maxsize."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def reserve(self, key, fingerprint, lock_timeout):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+            self._set(key, StoredRequest(fingerprint), now + lock_timeout)
+        return None
+
+    def save(self, key, fingerprint, response, ttl):
+        with self._lock:
+            self._set(key, StoredRequest(fingerprint, response), time.monotonic() + ttl)
+
+    def release(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _set(self, key, stored, expires):
+        self._entries[key] = (expires, stored)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class RedisIdempotencyBackend(IdempotencyBackend):
+    """Keys on a Redis server shared by all of the workers, stored as JSON.
+    Needs the redis package."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis package is needed to use a redis:// IDEMPOTENCY_URL.')
+        self.client = redis.Redis.from_url(url)
+
+    def reserve(self, key, fingerprint, lock_timeout):
+        name = self._name(key)
+        # SET NX only sets a key that doesn't exist, so one request wins
+        if self.client.set(name, StoredRequest(fingerprint).dumps(), nx=True, px=int(lock_timeout * 1000)):
+            return None
+        value = self.client.get(name)
+        # Released or expired in between, the retry can run
+        return StoredRequest(fingerprint) if value is None else StoredRequest.loads(value)
+
+    def save(self, key, fingerprint, response, ttl):
+        self.client.set(self._name(key), StoredRequest(fingerprint, response).dumps(), ex=int(ttl))
+
+    def release(self, key):
+        self.client.delete(self._name(key))
+
+    @staticmethod
+    def _name(key):
+        return f'idempotency:{key.hex()}'
+
+
+class DatabaseIdempotencyBackend(IdempotencyBackend):
+    """Keys in the idempotency_keys table of the primary database, shared by
+    all of the workers without another server. The key's primary key makes
+    concurrent reservations of the same key fail, and expired keys are
+    deleted every CLEANUP_INTERVAL seconds."""
+
+    def __init__(self):
+        self._next_cleanup = 0.0
+
+    def reserve(self, key, fingerprint, lock_timeout):
+        now = datetime.utcnow()
+        self._cleanup(now)
+        table = IdempotencyKey.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(table.delete().where(table.c.key == key, table.c.expires_at <= now))
+                connection.execute(table.insert().values(
+                    key=key, fingerprint=fingerprint, created_at=now,
+                    expires_at=now + timedelta(seconds=lock_timeout)
+                ))
+            return None
+        except IntegrityError:
+            pass
+
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                db.select(table.c.fingerprint, table.c.status_code, table.c.headers, table.c.body)
+                .where(table.c.key == key)
+            ).first()
+        if row is None:
+            # Released in between, so the other request failed and this one
+            # can be tried again
+            return StoredRequest(fingerprint)
+        response = None if row.status_code is None else (row.status_code, row.headers, row.body)
+        return StoredRequest(row.fingerprint, response)
+
+    def save(self, key, fingerprint, response, ttl):
+        status_code, headers, body = response
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(table.c.key == key).values(
+                status_code=status_code, headers=headers, body=body,
+                expires_at=datetime.utcnow() + timedelta(seconds=ttl)
+            ))
+
+    def release(self, key):
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.key == key))
+
+    def _cleanup(self, now):
+        if time.monotonic() < self._next_cleanup:
+            return
+        self._next_cleanup = time.monotonic() + CLEANUP_INTERVAL
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.expires_at <= now))
+
+
+# Gets the backend configured by IDEMPOTENCY_URL, the database if unset
+def idempotency_backend_from_url(url):
+    if not url or url == 'database://':
+        return DatabaseIdempotencyBackend()
+    if url == 'local://':
+        return LocalIdempotencyBackend()
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisIdempotencyBackend(url)
+    raise ValueError(f'Unsupported IDEMPOTENCY_URL: {url}')
+
+
+# ------------------------------
+# Idempotent routes
+# ------------------------------
+
+class IdempotencyStore:
+    """Replays the stored response of a write sent again with the same
+    Idempotency-Key, instead of writing again.
+
+    A key belongs to the client (the subject of its token, or the token
+    itself if it has none) that sent it, and can only be used again for the
+    same request. While the first request runs, the same key gets a 409
+    error; if that request fails, or the worker dies and the key's
+    lock_timeout passes, it can be sent again. Only successful responses are
+    stored, for ttl seconds.
+    """
+
+    def __init__(self, backend, ttl=86400, lock_timeout=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.stored = 0
+        self.replayed = 0
+        self.conflicts = 0
+        self.failed = 0
+
+    def stats(self):
+        return {
+            "stored": self.stored,
+            "replayed": self.replayed,
+            "conflicts": self.conflicts,
+            "failed": self.failed
+        }
+
+    # Who the keys of the current request belong to, see token_client
+    @staticmethod
+    def client():
+        return g.token_client
+
+    @staticmethod
+    def digest(subject, key):
+        return hashlib.sha256(f'{subject}\0{key}'.encode()).digest()
+
+    # The method, URL and body of the current request
+    @staticmethod
+    def fingerprint():
+        digest = hashlib.sha256(f'{request.method} {request.full_path}\n'.encode())
+        digest.update(request.get_data(cache=True))
+        return digest.hexdigest()
+
+    def respond(self, view, key):
+        digest = self.digest(self.client(), key)
+        fingerprint = self.fingerprint()
+        stored = self.backend.reserve(digest, fingerprint, self.lock_timeout)
+        if stored is not None:
+            if stored.fingerprint != fingerprint:
+                abort(422, "This Idempotency-Key was already used for another request.")
+            if stored.response is None:
+                self.conflicts += 1
+                abort(409, "A request with this Idempotency-Key is in progress.")
+            self.replayed += 1
+            status_code, headers, body = stored.response
+            response = current_app.response_class(body, status_code, headers)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = current_app.make_response(view())
+        except BaseException:
+            self.backend.release(digest)
+            raise
+        if response.status_code >= 400 or response.is_streamed:
+            self.backend.release(digest)
+            return response
+
+        # The write is committed, so the client gets its response even if it
+        # can't be stored. The key then stays locked until lock_timeout.
+        headers = [(name, response.headers[name]) for name in STORED_HEADERS if name in response.headers]
+        try:
+            self.backend.save(digest, fingerprint, (response.status_code, headers, response.get_data()), self.ttl)
+        except Exception:
+            self.failed += 1
+            logger.exception('Could not store the response of an idempotent request')
+            return response
+        self.stored += 1
+        return response
+
+
+# Makes a write route idempotent for the requests with an Idempotency-Key.
+# Goes under requires_auth, so the key is checked once the client is known.
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        store = current_app.extensions.get('idempotency')
+        if key is None or store is None:
+            return f(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(400, f"The Idempotency-Key must have 1 to {MAX_KEY_LENGTH} characters.")
+        return store.respond(lambda: f(*args, **kwargs), key)
+
+    return wrapper
+
+
+# Stores the responses of the idempotent routes, set with these settings:
+#   IDEMPOTENCY_URL           database:// (the default), local:// or redis://
+#   IDEMPOTENCY_TTL           Seconds a response is replayed for (default 86400)
+#   IDEMPOTENCY_LOCK_TIMEOUT  Seconds before a key whose request never
+#                             finished can be used again (default 60)
+def init_idempotency(app):
+    backend = idempotency_backend_from_url(get_setting(app, 'IDEMPOTENCY_URL', None))
+    app.extensions['idempotency'] = IdempotencyStore(
+        backend,
+        get_setting(app, 'IDEMPOTENCY_TTL', 86400, int),
+        get_setting(app, 'IDEMPOTENCY_LOCK_TIMEOUT', 60, float)
+    )
+    return app.extensions['idempotency']
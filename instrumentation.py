@@ -0,0 +1,269 @@
+import hmac
+import itertools
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import get_setting, parse_bool
+from ratelimit import LocalRateLimitBackend, parse_limit
+
+# Histogram buckets of the request latencies, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Phases timed in every request. auth includes jwks, the time spent getting
+# the signing keys.
+PHASES = ('auth', 'jwks', 'db', 'serialize', 'compress')
+
+# Requests with an X-Profile header holding PROFILE_SECRET are profiled when
+# both are set, and their profiles written here as collapsed stacks (for
+# flamegraph.pl or speedscope). Each worker profiles at most
+# PROFILE_RATE_LIMIT requests, so the header can't fill the disk.
+PROFILE_DIR = os.getenv('PROFILE_DIR')
+PROFILE_SECRET = os.getenv('PROFILE_SECRET')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.001))
+PROFILE_RATE_LIMIT = parse_limit(os.getenv('PROFILE_RATE_LIMIT', '10/m'))
+
+
+# ------------------------------
+# Phases
+# ------------------------------
+
+# Timings of the current request. The same dict is updated by the queries
+# of a streamed body, which run after the response has started.
+def request_stats():
+    return g.setdefault('request_stats', {'queries': 0, 'phases': {}})
+
+# Adds seconds to a phase of the current request
+def record_phase(name, seconds):
+    if has_request_context():
+        phases = request_stats()['phases']
+        phases[name] = phases.get(name, 0.0) + seconds
+
+# Times the block as a phase of the current request
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - start)
+
+
+# Every query of every engine counts towards the db phase of the request
+# that sent it
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_start')
+    if not starts:
+        return
+    record_phase('db', time.perf_counter() - starts.pop())
+    if has_request_context():
+        request_stats()['queries'] += 1
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # A failed query never reaches after_cursor_execute
+    if context.connection is not None:
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
+
+
+# ------------------------------
+# Metrics
+# ------------------------------
+
+class Metrics:
+    """Request metrics of this process, in the Prometheus text format.
+
+    Each gunicorn worker keeps its own, so a scrape only sees the worker
+    that answered it. Run one worker, or scrape each of them, to see all.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, status, seconds, queries, phases):
+        with self._lock:
+            key = (method, route, str(status))
+            entry = self._requests.get(key)
+            if entry is None:
+                entry = self._requests[key] = {
+                    'buckets': [0] * len(self.buckets),
+                    'count': 0,
+                    'sum': 0.0,
+                    'queries': 0,
+                    'phases': dict.fromkeys(PHASES, 0.0)
+                }
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry['buckets'][index] += 1
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['queries'] += queries
+            for phase, value in phases.items():
+                entry['phases'][phase] = entry['phases'].get(phase, 0.0) + value
+
+    def clear(self):
+        with self._lock:
+            self._requests.clear()
+
+    def render(self):
+        lines = [
+            '# HELP http_request_duration_seconds Time to answer a request, including streaming the body.',
+            '# TYPE http_request_duration_seconds histogram'
+        ]
+        with self._lock:
+            requests = sorted(self._requests.items())
+            for (method, route, status), entry in requests:
+                labels = f'method="{method}",route="{route}",status="{status}"'
+                for bound, count in zip(self.buckets, entry['buckets']):
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {entry["count"]}')
+                lines.append(f'http_request_duration_seconds_sum{{{labels}}} {entry["sum"]}')
+                lines.append(f'http_request_duration_seconds_count{{{labels}}} {entry["count"]}')
+
+            lines.append('# HELP http_request_sql_queries_total SQL queries sent while answering requests.')
+            lines.append('# TYPE http_request_sql_queries_total counter')
+            for (method, route, status), entry in requests:
+                lines.append(f'http_request_sql_queries_total{{method="{method}",route="{route}",status="{status}"}} {entry["queries"]}')
+
+            lines.append('# HELP http_request_phase_seconds_total Time spent in each phase of the requests.')
+            lines.append('# TYPE http_request_phase_seconds_total counter')
+            for (method, route, status), entry in requests:
+                for phase, seconds in entry['phases'].items():
+                    lines.append(f'http_request_phase_seconds_total{{method="{method}",route="{route}",status="{status}",phase="{phase}"}} {seconds}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+# ------------------------------
+# Profiler
+# ------------------------------
+
+class SamplingProfiler:
+    """Samples the stack of one thread every interval seconds from a
+    background thread. Only costs anything while it runs."""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    # One line per stack with the number of samples it was seen in
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+# Profiles of this worker, as a token bucket, and their numbers
+profile_bucket = LocalRateLimitBackend(maxsize=1)
+_profile_numbers = itertools.count(1)
+
+# Whether the request sent the secret, and the worker can profile it
+def _should_profile():
+    secret = request.headers.get('X-Profile')
+    if not PROFILE_DIR or not PROFILE_SECRET or secret is None:
+        return False
+    if not hmac.compare_digest(secret.encode(), PROFILE_SECRET.encode()):
+        return False
+    return profile_bucket.take('profile', *PROFILE_RATE_LIMIT) == 0
+
+def _start_profiler():
+    if _should_profile():
+        g.profiler = SamplingProfiler(threading.get_ident())
+        g.profiler.start()
+
+def _save_profile(profiler, method, route):
+    profiler.stop()
+    route_name = re.sub(r'\W+', '_', route).strip('_') or 'index'
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{method}-{route_name}-{os.getpid()}-{next(_profile_numbers)}.txt"
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, name), 'w') as f:
+        f.write(profiler.collapsed())
+    return name
+
+
+# ------------------------------
+# Hooks
+# ------------------------------
+
+def _before_request():
+    g.request_start = time.perf_counter()
+    _start_profiler()
+
+def _after_request(response):
+    if 'request_start' not in g:
+        return response
+    stats = request_stats()
+    start = g.request_start
+
+    if current_app.config['SERVER_TIMING']:
+        phases = stats['phases']
+        timings = [f'{phase};dur={phases[phase] * 1000:.2f}' for phase in PHASES if phase in phases]
+        timings.append(f'queries;desc="{stats["queries"]}"')
+        timings.append(f'total;dur={(time.perf_counter() - start) * 1000:.2f}')
+        response.headers['Server-Timing'] = ', '.join(timings)
+
+    method = request.method
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        response.headers['X-Profile'] = _save_profile(profiler, method, route)
+
+    # Streamed bodies are only done when the server closes the response
+    def observe():
+        metrics.observe(method, route, response.status_code, time.perf_counter() - start, stats['queries'], stats['phases'])
+    response.call_on_close(observe)
+    return response
+
+def _metrics(payload):
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Adds the timing hooks and the GET /metrics route to app. Call it before
+# registering other after_request hooks so the timings include them. The
+# Server-Timing header can be turned off with SERVER_TIMING=false.
+def init_instrumentation(app):
+    # auth.py times its work with this module, so it is imported here
+    from auth import requires_auth
+
+    app.config.setdefault('SERVER_TIMING', get_setting(app, 'SERVER_TIMING', True, parse_bool))
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    # Like GET /stats, the metrics are for the operators only
+    app.add_url_rule('/metrics', 'metrics', requires_auth('get:stats')(_metrics))
@@ -0,0 +1,94 @@
+import dataclasses
+import decimal
+import json
+import os
+import uuid
+from datetime import date, datetime, timezone
+from flask.json.provider import JSONProvider
+
+from instrumentation import timed
+
+# orjson is optional, without it the json module is used with the same output
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Which library serializes the responses: orjson (the default when it is
+# installed) or json
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'orjson' if orjson is not None else 'json')
+
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+# Serializes the types the json module doesn't know. Datetimes are written in
+# ISO 8601, naive ones (the columns store naive UTC times) as UTC.
+def default(o):
+    if isinstance(o, datetime):
+        if o.tzinfo is None:
+            o = o.replace(tzinfo=timezone.utc)
+        return o.isoformat()
+    if isinstance(o, date):
+        return o.isoformat()
+    if isinstance(o, (decimal.Decimal, uuid.UUID)):
+        return str(o)
+    if dataclasses.is_dataclass(o):
+        return dataclasses.asdict(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+# Encodes obj as compact UTF-8 JSON with the backend
+def encode(obj, backend=JSON_BACKEND):
+    if backend == 'orjson':
+        return orjson.dumps(obj, default=default, option=ORJSON_OPTIONS)
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':')).encode()
+
+def decode(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+class FastJSONProvider(JSONProvider):
+    """JSON provider writing compact UTF-8 JSON with ISO 8601 datetimes.
+
+    Uses orjson when it is installed, which is several times faster than the
+    json module on large lists. Responses are built from the encoded bytes
+    directly, without going through a str.
+    """
+
+    mimetype = 'application/json'
+
+    def __init__(self, app, backend=None):
+        super().__init__(app)
+        self.backend = backend or JSON_BACKEND
+        if self.backend == 'orjson' and orjson is None:
+            raise RuntimeError('The orjson package is needed to use the orjson JSON_BACKEND.')
+        if self.backend not in ('orjson', 'json'):
+            raise ValueError(f'Unsupported JSON_BACKEND: {self.backend}')
+
+    def dumps_bytes(self, obj):
+        return encode(obj, self.backend)
+
+    def dumps(self, obj, **kwargs):
+        return self.dumps_bytes(obj).decode()
+
+    def loads(self, s, **kwargs):
+        if self.backend == 'orjson':
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    # Encodes each of the items on its own line, for newline delimited JSON
+    def dumps_lines(self, items):
+        if self.backend == 'orjson':
+            return b''.join([orjson.dumps(item, default=default, option=ORJSON_OPTIONS) + b'\n' for item in items])
+        return ''.join([json.dumps(item, default=default, ensure_ascii=False, separators=(',', ':')) + '\n' for item in items]).encode()
+
+    # Takes its arguments like jsonify: a single value as is, several as an
+    # array, or keyword arguments as an object
+    def response(self, *args, **kwargs):
+        if args and kwargs:
+            raise TypeError('response() takes either args or kwargs, not both.')
+        obj = args[0] if len(args) == 1 else args or kwargs or None
+        with timed('serialize'):
+            body = self.dumps_bytes(obj)
+        return self._app.response_class(body, mimetype=self.mimetype)
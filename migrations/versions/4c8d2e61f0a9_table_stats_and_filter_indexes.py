@@ -0,0 +1,48 @@
+"""Table stats and indexes on the list endpoint filters
+
+Revision ID: 4c8d2e61f0a9
+Revises: a1f3c9e2b7d4
+Create Date: 2023-04-18 10:37:52.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c8d2e61f0a9'
+down_revision = 'a1f3c9e2b7d4'
+branch_labels = None
+depends_on = None
+
+
+# On Postgres the indexes are built without locking the table for writes
+def create_index(name, table, columns):
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+    else:
+        op.create_index(name, table, columns)
+
+
+def upgrade():
+    op.create_table('table_stats',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_count', sa.Integer(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    # Seed the counts here so the app never has to
+    op.execute("INSERT INTO table_stats (table_name, row_count, version) SELECT 'actors', count(*), 1 FROM actors")
+    op.execute("INSERT INTO table_stats (table_name, row_count, version) SELECT 'movies', count(*), 1 FROM movies")
+
+    create_index(op.f('ix_actors_age'), 'actors', ['age'])
+    create_index(op.f('ix_actors_gender'), 'actors', ['gender'])
+    create_index(op.f('ix_movies_release_date'), 'movies', ['release_date'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_movies_release_date'), table_name='movies')
+    op.drop_index(op.f('ix_actors_gender'), table_name='actors')
+    op.drop_index(op.f('ix_actors_age'), table_name='actors')
+    op.drop_table('table_stats')
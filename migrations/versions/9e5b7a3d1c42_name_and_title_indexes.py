@@ -0,0 +1,52 @@
+"""Indexes on actor names and movie titles
+
+Revision ID: 9e5b7a3d1c42
+Revises: 4c8d2e61f0a9
+Create Date: 2026-10-18 14:05:26.730511
+
+B-tree indexes for sorting and exact matches, indexes on lower() for case
+insensitive matches, and on Postgres trigram indexes for ILIKE '%...%'
+searches.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e5b7a3d1c42'
+down_revision = '4c8d2e61f0a9'
+branch_labels = None
+depends_on = None
+
+
+# On Postgres the indexes are built without locking the table for writes
+def create_index(name, table, columns):
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+    else:
+        op.create_index(name, table, columns)
+
+
+def upgrade():
+    create_index(op.f('ix_actors_name'), 'actors', ['name'])
+    create_index(op.f('ix_movies_title'), 'movies', ['title'])
+    create_index('ix_actors_name_lower', 'actors', [sa.text('lower(name)')])
+    create_index('ix_movies_title_lower', 'movies', [sa.text('lower(title)')])
+
+    if op.get_context().dialect.name == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        with op.get_context().autocommit_block():
+            op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_actors_name_trgm ON actors USING gin (lower(name) gin_trgm_ops)')
+            op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_movies_title_trgm ON movies USING gin (lower(title) gin_trgm_ops)')
+
+
+def downgrade():
+    if op.get_context().dialect.name == 'postgresql':
+        op.execute('DROP INDEX IF EXISTS ix_movies_title_trgm')
+        op.execute('DROP INDEX IF EXISTS ix_actors_name_trgm')
+    op.drop_index('ix_movies_title_lower', table_name='movies')
+    op.drop_index('ix_actors_name_lower', table_name='actors')
+    op.drop_index(op.f('ix_movies_title'), table_name='movies')
+    op.drop_index(op.f('ix_actors_name'), table_name='actors')
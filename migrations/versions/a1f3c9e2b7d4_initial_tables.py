@@ -0,0 +1,40 @@
+"""Initial actors and movies tables
+
+Revision ID: a1f3c9e2b7d4
+Revises: 
+Create Date: 2023-04-01 14:02:11.403829
+
+Databases created with db.create_all() before migrations were added already
+have these tables, run `flask db stamp a1f3c9e2b7d4` on them once instead.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1f3c9e2b7d4'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('movies',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.String(), nullable=False),
+    sa.Column('release_date', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('actors',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('age', sa.Integer(), nullable=False),
+    sa.Column('gender', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('actors')
+    op.drop_table('movies')
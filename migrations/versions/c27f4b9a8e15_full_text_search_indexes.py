@@ -0,0 +1,34 @@
+"""Full text search indexes on actor names and movie titles
+
+Revision ID: c27f4b9a8e15
+Revises: 9e5b7a3d1c42
+Create Date: 2026-10-18 15:12:48.902217
+
+GIN indexes on the same to_tsvector('simple', ...) expressions that GET
+/search queries, Postgres only. Other databases use the search fallback.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c27f4b9a8e15'
+down_revision = '9e5b7a3d1c42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    with op.get_context().autocommit_block():
+        op.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_actors_name_fts ON actors USING gin (to_tsvector('simple', name))")
+        op.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_movies_title_fts ON movies USING gin (to_tsvector('simple', title))")
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+    op.execute('DROP INDEX IF EXISTS ix_movies_title_fts')
+    op.execute('DROP INDEX IF EXISTS ix_actors_name_fts')
@@ -0,0 +1,38 @@
+"""Cast table linking actors to the movies they play in
+
+Revision ID: e4b1d7c3a962
+Revises: c27f4b9a8e15
+Create Date: 2026-10-18 16:40:05.517360
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b1d7c3a962'
+down_revision = 'c27f4b9a8e15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cast',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.Column('role', sa.String(), nullable=True),
+    sa.Column('billing', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('movie_id', 'actor_id')
+    )
+    op.create_index(op.f('ix_cast_actor_id'), 'cast', ['actor_id'], unique=False)
+    op.execute("INSERT INTO table_stats (table_name, row_count, version) VALUES ('cast', 0, 1)")
+
+
+def downgrade():
+    op.execute("DELETE FROM table_stats WHERE table_name = 'cast'")
+    op.drop_index(op.f('ix_cast_actor_id'), table_name='cast')
+    op.drop_table('cast')
@@ -0,0 +1,50 @@
+"""Changes table for the change feed, and the audit log
+
+Revision ID: f3a8c1d5b207
+Revises: e4b1d7c3a962
+Create Date: 2026-10-18 19:12:44.208136
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a8c1d5b207'
+down_revision = 'e4b1d7c3a962'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('changes',
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('operation', sa.String(), nullable=False),
+    sa.Column('data', sa.JSON(), nullable=True),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('audit_log',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('first_change_id', sa.Integer(), nullable=False),
+    sa.Column('last_change_id', sa.Integer(), nullable=False),
+    sa.Column('subject', sa.String(), nullable=True),
+    sa.Column('permission', sa.String(), nullable=True),
+    sa.Column('method', sa.String(), nullable=True),
+    sa.Column('path', sa.String(), nullable=True),
+    sa.Column('remote_addr', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_audit_log_first_change_id'), 'audit_log', ['first_change_id'], unique=False)
+    # The version of the changes row is the last id given out
+    op.execute("INSERT INTO table_stats (table_name, row_count, version) VALUES ('changes', 0, 0)")
+
+
+def downgrade():
+    op.execute("DELETE FROM table_stats WHERE table_name = 'changes'")
+    op.drop_index(op.f('ix_audit_log_first_change_id'), table_name='audit_log')
+    op.drop_table('audit_log')
+    op.drop_table('changes')
@@ -1,27 +1,264 @@
 import os
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from flask import current_app, g, has_app_context, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from flask_migrate import Migrate
+from sqlalchemy import event
+from sqlalchemy.pool import NullPool
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 import json
 
-uri = os.environ['DATABASE_URL']
-if uri.startswith("postgres://"):
-    uri = uri.replace("postgres://", "postgresql://", 1)
 
-db = SQLAlchemy()
 
-def setup_db(app, database_path=uri):
+class RoutingSession(Session):
+    """Session sending the queries of read-only requests to a read replica
+    when replicas are set up (see replicas.py), and flushes and every other
+    query to the primary."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context():
+            router = current_app.extensions.get('replicas')
+            if router is not None:
+                engine = router.engine_for_request()
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+migrate = Migrate(directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations'))
+
+# Number of rows written per transaction by the bulk functions
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 1000))
+
+# Gets the database URL from the DATABASE_URL environment variable. Heroku
+# style postgres:// URLs are accepted.
+def get_database_url():
+    uri = os.getenv('DATABASE_URL')
+    if not uri:
+        raise RuntimeError('Set DATABASE_URL to the URL of the database.')
+    return normalize_database_url(uri)
+
+def normalize_database_url(uri):
+    if uri.startswith("postgres://"):
+        uri = uri.replace("postgres://", "postgresql://", 1)
+    return uri
+
+# Gets the URLs of the read replicas from a comma separated list
+def parse_url_list(value):
+    if isinstance(value, str):
+        value = value.split(',')
+    return [normalize_database_url(url.strip()) for url in value if url.strip()]
+
+# The schema is managed by the migrations in migrations/, apply them with
+# `flask db upgrade` before starting the app. Nothing connects to the
+# database here, the first connection is opened by the first query.
+def setup_db(app, database_path=None):
+    database_path = database_path or app.config.get("SQLALCHEMY_DATABASE_URI") or get_database_url()
     with app.app_context():
         app.config["SQLALCHEMY_DATABASE_URI"] = database_path
         app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+        app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", get_engine_options(app, database_path))
         db.app = app
         db.init_app(app)
-        db.create_all()
+        add_statement_timeout(app, db.engine)
+
+        migrate.init_app(app, db)
+
+
+# ------------------------------
+# Connection pool
+# ------------------------------
+
+def parse_bool(value):
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+# Gets a setting from the app config, falling back on the environment
+def get_setting(app, name, default, parse=str):
+    value = app.config.get(name, os.getenv(name))
+    if value is None or value == '':
+        return default
+    return parse(value)
+
+# Builds the engine options from these settings:
+#   DB_POOL_SIZE          Connections kept open per worker (default 5)
+#   DB_MAX_OVERFLOW       Extra connections opened under load (default 10)
+#   DB_POOL_TIMEOUT       Seconds to wait for a free connection (default 30)
+#   DB_POOL_RECYCLE       Seconds before a connection is replaced (default 1800)
+#   DB_POOL_PRE_PING      Test connections before using them (default true)
+#   DB_STATEMENT_TIMEOUT  Milliseconds before Postgres cancels a query (default none)
+#   DB_PGBOUNCER          Connect through PgBouncer in transaction mode (default false)
+def get_engine_options(app, database_path):
+    options = {}
+    if database_path.startswith('sqlite'):
+        return options
+
+    options['pool_pre_ping'] = get_setting(app, 'DB_POOL_PRE_PING', True, parse_bool)
+    connect_args = {}
+    statement_timeout = get_setting(app, 'DB_STATEMENT_TIMEOUT', None, int)
+
+    if get_setting(app, 'DB_PGBOUNCER', False, parse_bool):
+        # PgBouncer does the pooling, and rejects startup options. psycopg2
+        # never prepares statements, psycopg 3 has to be told not to.
+        options['poolclass'] = NullPool
+        if database_path.startswith('postgresql+psycopg:'):
+            connect_args['prepare_threshold'] = None
+    else:
+        options['pool_size'] = get_setting(app, 'DB_POOL_SIZE', 5, int)
+        options['max_overflow'] = get_setting(app, 'DB_MAX_OVERFLOW', 10, int)
+        options['pool_timeout'] = get_setting(app, 'DB_POOL_TIMEOUT', 30, int)
+        options['pool_recycle'] = get_setting(app, 'DB_POOL_RECYCLE', 1800, int)
+        if statement_timeout:
+            connect_args['options'] = f'-c statement_timeout={statement_timeout}'
+
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+# Sends the rest of the current request's queries to the primary, for reads
+# that are followed by a write
+def use_primary():
+    if has_request_context():
+        g.read_replica = None
+
+# Behind PgBouncer a session level SET would leak to other clients, so the
+# statement timeout is set for each transaction instead
+def add_statement_timeout(app, engine):
+    statement_timeout = get_setting(app, 'DB_STATEMENT_TIMEOUT', None, int)
+    if statement_timeout and get_setting(app, 'DB_PGBOUNCER', False, parse_bool):
+        @event.listens_for(engine, 'begin')
+        def set_statement_timeout(connection):
+            connection.exec_driver_sql(f'SET LOCAL statement_timeout = {statement_timeout}')
+
+# Gets the state of the connection pool of this worker
+def pool_stats():
+    pool = db.engine.pool
+    stats = {"class": type(pool).__name__}
+    for name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, name):
+            stats[name] = getattr(pool, name)()
+    return stats
+
+# ------------------------------
+# Validation
+# ------------------------------
+
+# Accepts datetimes, ISO 8601 strings and the HTTP dates the API returns.
+# Raises ValueError if the value is none of those.
+def parse_datetime(value):
+    if value is None or isinstance(value, datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            try:
+                parsed = parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'Invalid date: {value!r}')
+
+    # The columns store naive UTC times
+    if parsed is not None and parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+# Accepts integers and None
+def parse_optional_int(value):
+    if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+        raise ValueError('Expected an integer.')
+    return value
+
+# Returns the writable values of data for model. Raises ValueError if data
+# isn't an object, if a value can't be parsed, or (unless partial) if a field
+# is missing.
+def validate(model, data, partial=False):
+    if not isinstance(data, dict):
+        raise ValueError('Expected an object.')
+
+    values = {field: data[field] for field in model.fields if field in data}
+    if not partial and len(values) != len(model.fields):
+        raise ValueError('Missing fields.')
+    for field, parse in model.parsers.items():
+        if field in values:
+            values[field] = parse(values[field])
+    return values
+
+
+class TableStats(db.Model):
+    __tablename__ = 'table_stats'
+
+    # Row count and version of each table. Both are updated in the same
+    # transaction as the writes, so every worker sees the same values. The
+    # version goes up on every insert, update and delete.
+    table_name = db.Column(db.String, primary_key=True)
+    row_count = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    @classmethod
+    def get(cls, model):
+        # The stats are read at most once per request, until the next write
+        memo = g.setdefault('table_stats', {}) if has_request_context() else {}
+        if model.__tablename__ in memo:
+            return memo[model.__tablename__]
+
+        stats = db.session.execute(
+            db.select(cls.row_count, cls.version).where(cls.table_name == model.__tablename__)
+        ).one_or_none()
+        if stats is not None:
+            memo[model.__tablename__] = stats
+            return stats
+
+        # First use of the stats, seed them from the table
+        use_primary()
+        cls.seed(model)
+        db.session.commit()
+        return cls.get(model)
+
+    @classmethod
+    def count(cls, model):
+        return cls.get(model).row_count
+
+    @classmethod
+    def seed(cls, model, version=1):
+        # The count includes the changes of the current transaction
+        try:
+            with db.session.begin_nested():
+                row_count = db.session.query(db.func.count(model.id)).scalar()
+                db.session.add(cls(table_name=model.__tablename__, row_count=row_count, version=version))
+        except IntegrityError:
+            # Another worker seeded them first
+            return False
+        return True
+
+    @classmethod
+    def bump(cls, model, delta=0):
+        # Called before the commit of every write, delta is the change in rows
+        # Also outside of requests, a memo kept in the app context's g would
+        # be stale
+        if has_app_context():
+            g.pop('table_stats', None)
+        statement = (
+            db.update(cls)
+            .where(cls.table_name == model.__tablename__)
+            .values(row_count=cls.row_count + delta, version=cls.version + 1)
+        )
+        if db.session.execute(statement).rowcount == 0 and not cls.seed(model):
+            db.session.execute(statement)
+
 
 class Movie(db.Model):
     __tablename__ = 'movies'
 
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String, nullable=False)
-    release_date = db.Column(db.DateTime)
+    title = db.Column(db.String, nullable=False, index=True)
+    release_date = db.Column(db.DateTime, index=True)
+    cast = db.relationship('Cast', back_populates='movie', passive_deletes=True)
+
+    # Fields that can be set through the API, and how to parse them
+    fields = ('title', 'release_date')
+    parsers = {'release_date': parse_datetime}
     
     def __init__(self, title, release_date):
         self.title = title
@@ -29,13 +266,20 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        TableStats.bump(type(self), 1)
+        record_change(type(self), 'insert', self)
         db.session.commit()
 
     def update(self):
+        TableStats.bump(type(self))
+        record_change(type(self), 'update', self)
         db.session.commit()
 
     def delete(self):
+        Cast.remove_for(type(self), [self.id])
         db.session.delete(self)
+        TableStats.bump(type(self), -1)
+        record_change(type(self), 'delete', self.id)
         db.session.commit()
 
     def format(self):
@@ -50,9 +294,14 @@ class Actor(db.Model):
     __tablename__ = 'actors'
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String, nullable=False)
-    age = db.Column(db.Integer, nullable=False)
-    gender = db.Column(db.String, nullable=False)
+    name = db.Column(db.String, nullable=False, index=True)
+    age = db.Column(db.Integer, nullable=False, index=True)
+    gender = db.Column(db.String, nullable=False, index=True)
+    roles = db.relationship('Cast', back_populates='actor', passive_deletes=True)
+
+    # Fields that can be set through the API, and how to parse them
+    fields = ('name', 'age', 'gender')
+    parsers = {}
     
     def __init__(self, name, age, gender):
         self.name = name
@@ -61,13 +310,20 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        TableStats.bump(type(self), 1)
+        record_change(type(self), 'insert', self)
         db.session.commit()
 
     def update(self):
+        TableStats.bump(type(self))
+        record_change(type(self), 'update', self)
         db.session.commit()
 
     def delete(self):
+        Cast.remove_for(type(self), [self.id])
         db.session.delete(self)
+        TableStats.bump(type(self), -1)
+        record_change(type(self), 'delete', self.id)
         db.session.commit()
 
     def format(self):
@@ -77,3 +333,299 @@ class Actor(db.Model):
             "age": self.age,
             "gender": self.gender
         }
+
+
+class Cast(db.Model):
+    __tablename__ = 'cast'
+
+    # Which actors play in which movies, and as whom. billing is the actor's
+    # position in the credits, lowest first.
+    id = db.Column(db.Integer, primary_key=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id', ondelete='CASCADE'), nullable=False)
+    actor_id = db.Column(db.Integer, db.ForeignKey('actors.id', ondelete='CASCADE'), nullable=False, index=True)
+    role = db.Column(db.String)
+    billing = db.Column(db.Integer)
+    movie = db.relationship('Movie', back_populates='cast')
+    actor = db.relationship('Actor', back_populates='roles')
+
+    # The unique constraint also serves the lookups by movie_id
+    __table_args__ = (db.UniqueConstraint('movie_id', 'actor_id'),)
+
+    # Fields that can be set through the API, and how to parse them
+    fields = ('role', 'billing')
+    parsers = {'billing': parse_optional_int}
+
+    def format(self):
+        return {
+            "movie_id": self.movie_id,
+            "actor_id": self.actor_id,
+            "role": self.role,
+            "billing": self.billing
+        }
+
+    # Casts an actor in a movie, or changes their role. Returns the cast.
+    @classmethod
+    def put(cls, movie_id, actor_id, values):
+        cast = cls.query.filter_by(movie_id=movie_id, actor_id=actor_id).one_or_none()
+        if cast is None:
+            cast = cls(movie_id=movie_id, actor_id=actor_id)
+            db.session.add(cast)
+            TableStats.bump(cls, 1)
+            record_change(cls, 'insert', cast)
+        else:
+            TableStats.bump(cls)
+            record_change(cls, 'update', cast)
+        for field, value in values.items():
+            setattr(cast, field, value)
+        db.session.commit()
+        return cast
+
+    def delete(self):
+        db.session.delete(self)
+        TableStats.bump(type(self), -1)
+        record_change(type(self), 'delete', self.id, {"movie_id": self.movie_id, "actor_id": self.actor_id})
+        db.session.commit()
+
+    # Removes the casts of the movies or actors with the given ids, in the
+    # transaction that deletes them. The foreign keys cascade on Postgres,
+    # but the cast's stats have to be updated and SQLite doesn't enforce them.
+    @classmethod
+    def remove_for(cls, model, ids):
+        column = cls.movie_id if model is Movie else cls.actor_id
+        removed = db.session.execute(
+            db.delete(cls).where(column.in_(ids)).returning(cls.id, cls.movie_id, cls.actor_id)
+        ).all()
+        if removed:
+            TableStats.bump(cls, -len(removed))
+            for id, movie_id, actor_id in removed:
+                record_change(cls, 'delete', id, {"movie_id": movie_id, "actor_id": actor_id})
+        return len(removed)
+
+
+# Case insensitive lookups. On Postgres the migrations also add trigram
+# indexes (*_trgm) for ILIKE '%...%' searches.
+db.Index('ix_movies_title_lower', db.func.lower(Movie.title))
+db.Index('ix_actors_name_lower', db.func.lower(Actor.name))
+
+
+# ------------------------------
+# Changes
+# ------------------------------
+
+class Change(db.Model):
+    __tablename__ = 'changes'
+
+    # Append only log of the writes to the other tables, written in the same
+    # transaction. The ids are given out through the 'changes' row of
+    # table_stats, which stays locked until the commit, so they follow the
+    # order of the commits: a client that has read up to an id never misses
+    # a change committed later with a smaller one.
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    table_name = db.Column(db.String, nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String, nullable=False)
+    data = db.Column(db.JSON)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def format(self):
+        return {
+            "id": self.id,
+            "table": self.table_name,
+            "operation": self.operation,
+            "row_id": self.row_id,
+            "data": self.data,
+            "changed_at": self.changed_at
+        }
+
+    # Takes count ids, returns the last one
+    @classmethod
+    def reserve(cls, count):
+        if has_app_context():
+            g.pop('table_stats', None)
+        statement = (
+            db.update(TableStats)
+            .where(TableStats.table_name == cls.__tablename__)
+            .values(row_count=TableStats.row_count + count, version=TableStats.version + count)
+            .returning(TableStats.version)
+        )
+        last = db.session.execute(statement).scalar()
+        if last is None:
+            # The version is the last id given out
+            TableStats.seed(cls, db.session.query(db.func.coalesce(db.func.max(cls.id), 0)).scalar())
+            last = db.session.execute(statement).scalar()
+        return last
+
+
+class AuditEntry(db.Model):
+    __tablename__ = 'audit_log'
+
+    # Who made the changes from first_change_id to last_change_id, and
+    # through which route. Written after the commit by the audit queue in
+    # changes.py.
+    id = db.Column(db.Integer, primary_key=True)
+    first_change_id = db.Column(db.Integer, nullable=False, index=True)
+    last_change_id = db.Column(db.Integer, nullable=False)
+    subject = db.Column(db.String)
+    permission = db.Column(db.String)
+    method = db.Column(db.String)
+    path = db.Column(db.String)
+    remote_addr = db.Column(db.String)
+    created_at = db.Column(db.DateTime, nullable=False)
+
+
+# Records a change to a row of model, written with the other changes of the
+# transaction when it commits. row is either the model instance, whose id and
+# format() are read at the commit, or the id of the row with its data.
+def record_change(model, operation, row, data=None):
+    db.session.info.setdefault('changes', []).append((model.__tablename__, operation, row, data))
+
+# Datetimes are stored like the API writes them, in ISO 8601 in UTC
+def _jsonable(data):
+    if data is None:
+        return None
+    data = dict(data)
+    for key, value in data.items():
+        if isinstance(value, datetime):
+            if value.tzinfo is None:
+                value = value.replace(tzinfo=timezone.utc)
+            data[key] = value.isoformat()
+    return data
+
+# Writes the changes recorded in the transaction, last so the 'changes' row is
+# locked after the rows of the other tables and every writer locks in the
+# same order. The range of ids written is kept in session.info['committed']
+# for the after_commit hooks.
+@event.listens_for(RoutingSession, 'before_commit')
+def _write_changes(session):
+    if session.in_nested_transaction():
+        return
+    recorded = session.info.pop('changes', None)
+    if not recorded:
+        return
+
+    # Gives the new rows their ids
+    session.flush()
+    last = Change.reserve(len(recorded))
+    first = last - len(recorded) + 1
+    now = datetime.utcnow()
+    rows = []
+    for id, (table_name, operation, row, data) in enumerate(recorded, first):
+        if isinstance(row, db.Model):
+            row, data = row.id, row.format()
+        rows.append({
+            "id": id,
+            "table_name": table_name,
+            "row_id": row,
+            "operation": operation,
+            "data": _jsonable(data),
+            "changed_at": now
+        })
+    session.execute(db.insert(Change), rows)
+    session.info['committed'] = (first, last)
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop('changes', None)
+        session.info.pop('committed', None)
+
+
+# ------------------------------
+# Idempotency keys
+# ------------------------------
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    # The SHA-256 of the client and its Idempotency-Key, the request that
+    # used it and its response, which is null while the request runs. See
+    # idempotency.py.
+    key = db.Column(db.LargeBinary(32), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    headers = db.Column(db.JSON)
+    body = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+# ------------------------------
+# Bulk writes
+# ------------------------------
+# Each function writes its rows in transactions of BULK_CHUNK_SIZE rows and
+# returns one (id, error) pair per row, where error is None on success, 404 if
+# the row doesn't exist and 422 if the database rejected it.
+
+def bulk_insert(model, rows):
+    def write(chunk):
+        columns = [getattr(model, column.key) for column in model.__table__.columns]
+        # The rows of an executemany RETURNING only come back in the order of
+        # the chunk when asked for, or the ids would go to the wrong rows
+        inserted = db.session.execute(
+            db.insert(model).returning(*columns, sort_by_parameter_order=True), chunk
+        ).mappings().all()
+        TableStats.bump(model, len(inserted))
+        for row in inserted:
+            record_change(model, 'insert', row['id'], dict(row))
+        return [(row['id'], None) for row in inserted]
+
+    return _write_chunks(write, rows, lambda row: None)
+
+def bulk_update(model, rows):
+    def write(chunk):
+        existing = _existing_ids(model, [row['id'] for row in chunk])
+        found = [row for row in chunk if row['id'] in existing]
+        if found:
+            db.session.execute(db.update(model), found)
+            TableStats.bump(model)
+            updated = db.session.execute(
+                db.select(*model.__table__.columns).where(model.id.in_([row['id'] for row in found]))
+            ).mappings()
+            for row in updated:
+                record_change(model, 'update', row['id'], dict(row))
+        return [(row['id'], None if row['id'] in existing else 404) for row in chunk]
+
+    return _write_chunks(write, rows, lambda row: row['id'])
+
+def bulk_delete(model, ids):
+    def write(chunk):
+        existing = _existing_ids(model, chunk)
+        if existing:
+            Cast.remove_for(model, existing)
+            db.session.execute(db.delete(model).where(model.id.in_(existing)))
+            TableStats.bump(model, -len(existing))
+            for id in existing:
+                record_change(model, 'delete', id)
+        # Ids repeated in the batch are only deleted once
+        results = []
+        for id in chunk:
+            results.append((id, None if id in existing else 404))
+            existing.discard(id)
+        return results
+
+    return _write_chunks(write, ids, lambda id: id)
+
+def _existing_ids(model, ids):
+    return set(db.session.execute(db.select(model.id).where(model.id.in_(ids))).scalars())
+
+def _write_chunks(write, items, get_id):
+    results = []
+    for start in range(0, len(items), BULK_CHUNK_SIZE):
+        results.extend(_write_chunk(write, items[start:start + BULK_CHUNK_SIZE], get_id))
+    return results
+
+def _write_chunk(write, chunk, get_id):
+    try:
+        results = write(chunk)
+        db.session.commit()
+        return results
+    except SQLAlchemyError:
+        db.session.rollback()
+        if len(chunk) == 1:
+            return [(get_id(chunk[0]), 422)]
+
+    # Retry the rows one by one to find the ones the database rejects
+    results = []
+    for item in chunk:
+        results.extend(_write_chunk(write, [item], get_id))
+    return results
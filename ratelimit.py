@@ -0,0 +1,176 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Request limits of each role, as JSON. Each role maps to a limit for all of
+# its permissions, or to an object with a limit per permission and "*" for
+# the others. A limit is "<requests>/<period>" with a period of s, m or h,
+# e.g. "600/m": a client can send up to 600 requests at once, and then 10 per
+# second. Tokens with no role use the "default" limits. Unset, nothing is
+# limited.
+#   RATE_LIMITS='{"default": "5/s", "Executive Producer": {"*": "50/s", "get:movie": "20/s"}}'
+RATE_LIMITS = os.getenv('RATE_LIMITS')
+
+# Where the buckets are kept: in each worker's memory, or in a shared
+# redis:// server so every worker counts the same requests
+RATE_LIMIT_URL = os.getenv('RATE_LIMIT_URL', os.getenv('CACHE_URL'))
+
+# Maximum number of buckets kept in each worker's memory
+RATE_LIMIT_SIZE = int(os.getenv('RATE_LIMIT_SIZE', 10000))
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+# ------------------------------
+# Limits
+# ------------------------------
+
+# Parses a "<requests>/<period>" limit into the size of the bucket and the
+# tokens added to it per second
+def parse_limit(value):
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*([smh])\s*', value)
+    if match is None or int(match.group(1)) == 0:
+        raise ValueError(f'Invalid rate limit: {value!r}')
+    capacity = int(match.group(1))
+    return capacity, capacity / PERIODS[match.group(2)]
+
+# Parses RATE_LIMITS into {role: {permission: (capacity, rate)}}
+def parse_limits(config):
+    if isinstance(config, str):
+        config = json.loads(config)
+    limits = {}
+    for role, value in config.items():
+        if isinstance(value, str):
+            value = {'*': value}
+        limits[role] = {permission: parse_limit(limit) for permission, limit in value.items()}
+    return limits
+
+
+# ------------------------------
+# Backends
+# ------------------------------
+
+class RateLimitBackend:
+    """Interface of the storage of the token buckets."""
+
+    # Takes a token from the bucket of key, filled up to capacity with rate
+    # tokens per second. Returns 0 if there was one, or the seconds until
+    # there is.
+    def take(self, key, capacity, rate):
+        raise NotImplementedError
+
+
+class LocalRateLimitBackend(RateLimitBackend):
+    """Buckets in the worker's memory. The least recently used ones are
+    dropped past maxsize, which only lets their clients start over."""
+
+    def __init__(self, maxsize=RATE_LIMIT_SIZE):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                self._buckets.move_to_end(key)
+
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+# Updates a bucket in one step, so the workers can't take the same token
+REDIS_TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = capacity
+if bucket[1] then
+    tokens = math.min(capacity, tonumber(bucket[1]) + math.max(0, now - tonumber(bucket[2])) * rate)
+end
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """Buckets on a Redis server shared by all of the workers. Needs the redis
+    package, and costs a round trip to the server per request."""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis package is needed to use a redis:// RATE_LIMIT_URL.')
+        self.client = redis.Redis.from_url(url)
+        self._take = self.client.register_script(REDIS_TAKE_SCRIPT)
+
+    def take(self, key, capacity, rate):
+        return float(self._take(keys=[f'rate-limit:{key}'], args=[capacity, rate, time.time()]))
+
+
+# Gets the backend configured by RATE_LIMIT_URL
+def rate_limit_backend_from_url(url):
+    if not url or url == 'local://':
+        return LocalRateLimitBackend()
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisRateLimitBackend(url)
+    raise ValueError(f'Unsupported RATE_LIMIT_URL: {url}')
+
+
+# ------------------------------
+# Limiter
+# ------------------------------
+
+class RateLimiter:
+    """Token bucket rate limiter, with one bucket per client and permission."""
+
+    def __init__(self, limits=None, backend=None):
+        self.backend = backend or LocalRateLimitBackend()
+        self.set_limits(limits or {})
+
+    def set_limits(self, limits):
+        self.limits = parse_limits(limits)
+
+    # Gets the bucket size and rate of a role and permission, or None
+    def get_limit(self, role, permission):
+        limits = self.limits.get(role)
+        if limits is None:
+            limits = self.limits.get('default')
+            if limits is None:
+                return None
+        limit = limits.get(permission)
+        return limit if limit is not None else limits.get('*')
+
+    # Returns 0 if the client can send the request, or the seconds until it can
+    def check(self, subject, role, permission):
+        limit = self.get_limit(role, permission)
+        if limit is None:
+            return 0.0
+        return self.backend.take(f'{subject}:{permission}', *limit)
+
+
+rate_limiter = RateLimiter(RATE_LIMITS, rate_limit_backend_from_url(RATE_LIMIT_URL))
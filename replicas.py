@@ -0,0 +1,189 @@
+import random
+import threading
+import time
+from flask import g, request
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from cache import LocalBackend, read_cache
+from models import add_statement_timeout, get_engine_options, get_setting, parse_url_list
+
+# Requests with these methods only read, so they can be answered by a replica
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Seconds the replica is behind the primary. A replica that has replayed
+# everything it received isn't behind, even if nothing was written for a while.
+POSTGRES_LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+# ------------------------------
+# Replicas
+# ------------------------------
+
+class Replica:
+    """A read replica engine and whether it can be used.
+
+    The replica is checked by the first request that wants it once the last
+    check is check_interval seconds old, or retry_interval seconds after it
+    failed. Until then the result of the last check is used.
+    """
+
+    def __init__(self, name, engine, check_interval=10, retry_interval=30, max_lag=None):
+        self.name = name
+        self.engine = engine
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.max_lag = max_lag
+        self.healthy = False
+        self.lag = None
+        self.error = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        event.listen(engine, 'handle_error', self._handle_error)
+
+    # Whether queries can be sent to the replica. Only one thread checks it
+    # at a time, the others use the last result meanwhile.
+    def available(self):
+        if time.monotonic() >= self._next_check and self._lock.acquire(blocking=False):
+            try:
+                self.check()
+            finally:
+                self._lock.release()
+        return self.healthy
+
+    def check(self):
+        try:
+            with self.engine.connect() as connection:
+                if connection.dialect.name == 'postgresql':
+                    lag = connection.execute(POSTGRES_LAG_QUERY).scalar()
+                    self.lag = float(lag) if lag is not None else None
+                else:
+                    connection.execute(text('SELECT 1'))
+                    self.lag = 0.0
+        except SQLAlchemyError as e:
+            self.mark_down(e)
+            return
+
+        if self.max_lag is not None and (self.lag is None or self.lag > self.max_lag):
+            self.healthy = False
+            self.error = 'Replication lag unknown.' if self.lag is None else f'{self.lag:.1f} seconds behind.'
+        else:
+            self.healthy = True
+            self.error = None
+        self._next_check = time.monotonic() + self.check_interval
+
+    def mark_down(self, error):
+        self.healthy = False
+        self.error = str(error).splitlines()[0] if str(error) else type(error).__name__
+        self._next_check = time.monotonic() + self.retry_interval
+
+    def stats(self):
+        return {
+            "healthy": self.healthy,
+            "lag": self.lag,
+            "error": self.error
+        }
+
+    # A lost connection takes the replica out until its next check, so the
+    # following requests go to the primary
+    def _handle_error(self, context):
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.original_exception)
+
+
+# ------------------------------
+# Routing
+# ------------------------------
+
+class ReplicaRouter:
+    """Chooses the engine of the queries of each request: a healthy replica
+    for read-only requests, the primary for everything else.
+
+    A client that has just written reads from the primary for sticky_seconds,
+    so it sees its own writes even while the replicas catch up. Clients are
+    told apart by the subject of their token, and remembered in the shared
+    cache backend when there is one so every worker knows.
+    """
+
+    def __init__(self, replicas, sticky_seconds=10, backend=None):
+        self.replicas = replicas
+        self.sticky_seconds = sticky_seconds
+        self.backend = backend or LocalBackend()
+
+    # Gets the replica engine of the current request, or None for the
+    # primary. All of the request's queries go to the same engine.
+    def engine_for_request(self):
+        if 'read_replica' not in g:
+            g.read_replica = self.choose() if self.can_use_replica() else None
+        return g.read_replica
+
+    def can_use_replica(self):
+        return request.method in READ_METHODS and not self.is_sticky(g.get('token_subject'))
+
+    # Gets the engine of a healthy replica, or None if there isn't one
+    def choose(self):
+        for replica in random.sample(self.replicas, len(self.replicas)):
+            if replica.available():
+                return replica.engine
+        return None
+
+    def is_sticky(self, subject):
+        return subject is not None and self.backend.get(self.sticky_key(subject)) is not None
+
+    def stick(self, subject):
+        self.backend.set(self.sticky_key(subject), True, self.sticky_seconds)
+
+    @staticmethod
+    def sticky_key(subject):
+        return f'replica-sticky:{subject}'
+
+    def after_request(self, response):
+        subject = g.get('token_subject')
+        if (subject is not None and self.sticky_seconds > 0
+                and request.method not in READ_METHODS and response.status_code < 400):
+            self.stick(subject)
+        return response
+
+    def stats(self):
+        return {replica.name: replica.stats() for replica in self.replicas}
+
+
+# Routes the reads to the replicas in DATABASE_REPLICA_URLS (comma
+# separated), if any. Each replica gets its own engine with the same pool
+# settings as the primary. Set with these settings:
+#   REPLICA_CHECK_INTERVAL  Seconds between the checks of a replica (default 10)
+#   REPLICA_RETRY_INTERVAL  Seconds before a failed replica is tried again (default 30)
+#   REPLICA_MAX_LAG         Seconds a replica can be behind and still be used (default 5)
+#   REPLICA_STICKY_SECONDS  Seconds a client reads from the primary after writing (default 10)
+# A worker only knows the writers it answered unless CACHE_URL is set, so
+# with more than one worker (WEB_CONCURRENCY) the replicas need it.
+def init_replicas(app):
+    urls = get_setting(app, 'DATABASE_REPLICA_URLS', [], parse_url_list)
+    if not urls:
+        return None
+
+    sticky_seconds = get_setting(app, 'REPLICA_STICKY_SECONDS', 10, int)
+    workers = get_setting(app, 'WEB_CONCURRENCY', 1, int)
+    if sticky_seconds > 0 and workers > 1 and read_cache.backend is None:
+        raise RuntimeError(
+            f'Read replicas with {workers} workers need a CACHE_URL, so every worker sends the reads '
+            'of a client that just wrote to the primary.'
+        )
+
+    check_interval = get_setting(app, 'REPLICA_CHECK_INTERVAL', 10, float)
+    retry_interval = get_setting(app, 'REPLICA_RETRY_INTERVAL', 30, float)
+    max_lag = get_setting(app, 'REPLICA_MAX_LAG', 5, float)
+    replicas = []
+    for url in urls:
+        engine = create_engine(url, **get_engine_options(app, url))
+        add_statement_timeout(app, engine)
+        name = engine.url.render_as_string(hide_password=True)
+        replicas.append(Replica(name, engine, check_interval, retry_interval, max_lag))
+
+    router = ReplicaRouter(replicas, sticky_seconds, read_cache.backend)
+    app.extensions['replicas'] = router
+    app.after_request(router.after_request)
+    return router
@@ -0,0 +1,188 @@
+import base64
+import json
+import re
+import threading
+
+from models import db, Actor, Movie, TableStats
+
+# Searchable text of each result type
+SEARCH_TYPES = {
+    'actors': (Actor, Actor.name),
+    'movies': (Movie, Movie.title)
+}
+
+WORD = re.compile(r'\w+')
+
+# Postgres ranks are rounded to this many steps, so a rank read back from a
+# cursor compares equal to the one in the database
+RANK_SCALE = 1000000
+
+
+# ------------------------------
+# Cursors
+# ------------------------------
+# Results are ordered by rank (best first), then type, then id. A cursor is the
+# (rank, type, id) of the last result of a page.
+
+def encode_cursor(rank, type, id):
+    return base64.urlsafe_b64encode(json.dumps([rank, type, id]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        rank, type, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError('Invalid cursor.')
+    if not isinstance(rank, (int, float)) or type not in SEARCH_TYPES or not isinstance(id, int):
+        raise ValueError('Invalid cursor.')
+    return rank, type, id
+
+# The integer a Postgres rank is stored and compared as
+def scaled_rank(rank):
+    return round(rank * RANK_SCALE)
+
+# Whether a result of type with rank and id comes after the cursor
+def comes_after(rank, type, id, cursor):
+    cursor_rank, cursor_type, cursor_id = cursor
+    if type == cursor_type:
+        return rank < cursor_rank or (rank == cursor_rank and id > cursor_id)
+    if type > cursor_type:
+        return rank <= cursor_rank
+    return rank < cursor_rank
+
+# The same check as comes_after, as a SQL condition
+def after_clause(rank, type, id, cursor):
+    cursor_rank, cursor_type, cursor_id = cursor
+    if type == cursor_type:
+        return db.or_(rank < cursor_rank, db.and_(rank == cursor_rank, id > cursor_id))
+    if type > cursor_type:
+        return rank <= cursor_rank
+    return rank < cursor_rank
+
+
+# ------------------------------
+# Search
+# ------------------------------
+
+# Searches the given types for q. Returns up to limit (rank, type, id, text)
+# results and the cursor of the next page, or None on the last page.
+def search_text(q, types, limit, cursor=None):
+    words = WORD.findall(q.lower())
+    if not words:
+        raise ValueError('Nothing to search for.')
+    position = decode_cursor(cursor) if cursor else None
+
+    results = []
+    for type in types:
+        if db.engine.dialect.name == 'postgresql':
+            rows = search_postgres(type, words, limit + 1, position)
+        else:
+            rows = search_fallback(type, words, limit + 1, position)
+        results.extend((rank, type, id, text) for rank, id, text in rows)
+
+    results.sort(key=lambda result: (-result[0], result[1], result[2]))
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = encode_cursor(*results[-1][:3])
+    return results, next_cursor
+
+
+# Uses the GIN indexes on to_tsvector('simple', ...) for prefix matches of all
+# of the words, and the trigram indexes for misspellings (a similarity of at
+# least pg_trgm.similarity_threshold, 0.3 by default)
+def search_postgres(type, words, limit, position):
+    model, column = SEARCH_TYPES[type]
+    phrase = ' '.join(words)
+    vector = db.func.to_tsvector(db.literal_column("'simple'"), column)
+    query = db.func.to_tsquery(db.literal_column("'simple'"), ' & '.join(f'{word}:*' for word in words))
+    lowered = db.func.lower(column)
+    # ts_rank and similarity are reals (float4), which don't compare equal
+    # to the double they become in the cursor. The rank is rounded once to
+    # an integer, used for the order, the cursor and the comparison.
+    rank = db.cast(db.func.round(db.cast(
+        db.func.greatest(db.func.ts_rank(vector, query), db.func.similarity(lowered, phrase)), db.Float
+    ) * RANK_SCALE), db.Integer)
+
+    statement = (
+        db.select(rank, model.id, column)
+        .where(db.or_(vector.op('@@')(query), lowered.op('%')(phrase)))
+        .order_by(rank.desc(), model.id)
+        .limit(limit)
+    )
+    if position is not None:
+        position_rank, position_type, position_id = position
+        statement = statement.where(after_clause(rank, type, model.id, (scaled_rank(position_rank), position_type, position_id)))
+    return [(rank / RANK_SCALE, id, text) for rank, id, text in db.session.execute(statement)]
+
+
+# ------------------------------
+# Fallback index
+# ------------------------------
+
+# Whether two words are at most one insertion, deletion or substitution apart
+def within_one_edit(a, b):
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    for i in range(len(a)):
+        if a[i] != b[i]:
+            if len(a) == len(b):
+                return a[i + 1:] == b[i + 1:]
+            return a[i:] == b[i + 1:]
+    return True
+
+
+class FallbackIndex:
+    """Pure Python stand-in for the Postgres full text index, used on SQLite.
+
+    Words match indexed words they are a prefix of, or (from 4 letters on)
+    that are one typo away. The rank is the share of the words that matched,
+    with typos counting for half.
+    """
+
+    def __init__(self, rows):
+        self.texts = {}
+        self.words = {}
+        for id, text in rows:
+            self.texts[id] = text
+            for word in set(WORD.findall((text or '').lower())):
+                self.words.setdefault(word, set()).add(id)
+
+    def search(self, words):
+        scores = {}
+        for word in words:
+            weights = {}
+            for indexed_word, ids in self.words.items():
+                if indexed_word.startswith(word):
+                    weight = 1.0
+                elif len(word) >= 4 and within_one_edit(indexed_word, word):
+                    weight = 0.5
+                else:
+                    continue
+                for id in ids:
+                    weights[id] = max(weights.get(id, 0.0), weight)
+            for id, weight in weights.items():
+                scores[id] = scores.get(id, 0.0) + weight
+        return [(score / len(words), id, self.texts[id]) for id, score in scores.items()]
+
+
+# One index per type, rebuilt when the table version changes
+_fallback_indexes = {}
+_fallback_lock = threading.Lock()
+
+def search_fallback(type, words, limit, position):
+    model, column = SEARCH_TYPES[type]
+    version = TableStats.get(model).version
+    with _fallback_lock:
+        cached = _fallback_indexes.get(type)
+        if cached is None or cached[0] != version:
+            rows = db.session.execute(db.select(model.id, column)).all()
+            cached = (version, FallbackIndex(rows))
+            _fallback_indexes[type] = cached
+
+    rows = cached[1].search(words)
+    if position is not None:
+        rows = [row for row in rows if comes_after(row[0], type, row[1], position)]
+    rows.sort(key=lambda row: (-row[0], row[1]))
+    return rows[:limit]